@@ -0,0 +1,50 @@
+# -*- coding: utf8 -*-
+
+# Benchmark of group_similar against the previous nested groupsimilar,
+# which compared each subpart with all remaining ones and removed the matches from a list.
+# Uses the from provinces in the bundled change table as subparts, many per country,
+# like an event that dissolves a whole country. Also checks that the groups are the same.
+# Run with: python benchmarks/bench_group_similar.py
+
+import os
+import sys
+import itertools
+import timeit
+
+# run as a script, so make the pshapes package in the repository root importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pshapes.process import Remainder, ids_equal, group_similar
+
+from bench_ids_equal import load_provs
+
+def legacy_groupsimilar(allsubparts):
+    key = lambda ch: ch.fromprov.country
+    for fromprovcountry,subparts in itertools.groupby(sorted(allsubparts, key=key), key=key):
+        subparts = list(subparts)
+        grp = []
+        while subparts:
+            frst = subparts.pop(0)
+            grp.append(frst)
+            for nxt in reversed(subparts):
+                if ids_equal(frst.fromprov,nxt.fromprov):
+                    grp.append(nxt)
+                    subparts.remove(nxt)
+            yield fromprovcountry, grp
+            grp = []
+
+def groups(groupfunc, subparts):
+    return [(country, [id(part) for part in grp]) for country,grp in groupfunc(subparts)]
+
+if __name__ == "__main__":
+    filename = os.path.join(os.path.dirname(__file__), "..", "pshapes_raw_auto.csv")
+    provs = load_provs(filename)[::2][:3000]
+    subparts = [Remainder(prov, None) for prov in provs]
+    assert groups(legacy_groupsimilar, subparts) == groups(group_similar, subparts)
+
+    print "%s subparts, %s groups" % (len(subparts), len(groups(group_similar, subparts)))
+    legacy = min(timeit.repeat(lambda: groups(legacy_groupsimilar, subparts), number=1, repeat=3))
+    print "legacy groupsimilar: %.3f s" % legacy
+    keyed = min(timeit.repeat(lambda: groups(group_similar, subparts), number=1, repeat=3))
+    print "keyed group_similar: %.3f s" % keyed
+    print "speedup: %.1fx" % (legacy / keyed)
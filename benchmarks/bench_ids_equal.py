@@ -0,0 +1,70 @@
+# -*- coding: utf8 -*-
+
+# Micro-benchmark of ids_equal against the previous version,
+# which rebuilt and unidecoded both name lists on every comparison.
+# Uses all the from and to provinces in the bundled change table.
+# Run with: python benchmarks/bench_ids_equal.py
+
+import os
+import sys
+import csv
+import timeit
+from unidecode import unidecode
+
+# run as a script, so make the pshapes package in the repository root importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pshapes.process import Province, ids_equal
+
+def legacy_ids_equal(find, comparison):
+    match = False
+    if find.country == comparison.country:
+        names = [find.ids["Name"]] + find.ids["Alterns"]
+        names += [unidecode(n) for n in names if n != unidecode(n)]
+        for name in names:
+            compnames = [comparison.ids["Name"]] + comparison.ids["Alterns"]
+            compnames += [unidecode(n) for n in compnames if n != unidecode(n)]
+            match = name in compnames
+            if match:
+                break
+        if not match:
+            match = find.ids["HASC"] and len(find.ids["HASC"]) > 3 and comparison.ids["HASC"] == find.ids["HASC"]
+            if match: return match
+            match = find.ids["ISO"] and comparison.ids["ISO"] == find.ids["ISO"]
+            if match: return match
+            match = find.ids["FIPS"] and comparison.ids["FIPS"] == find.ids["FIPS"]
+            if match: return match
+    return match
+
+def load_provs(filename):
+    provs = []
+    with open(filename, "rb") as reader:
+        for row in csv.DictReader(reader):
+            for side in ("from","to"):
+                val = lambda field: row[side+field].decode("utf8") or None
+                provs.append(Province(country=val("country"),
+                                      start=None,
+                                      end=None,
+                                      ids={"Name": val("name").strip(),
+                                           "Alterns": [alt.strip() for alt in val("alterns").split("|")] if val("alterns") else [],
+                                           "HASC": val("hasc"),
+                                           "ISO": val("iso"),
+                                           "FIPS": val("fips")},
+                                      other={},
+                                      geometry=None))
+    return provs
+
+def compare_all(matchfunc, provs):
+    return sum(1 for find in provs for comparison in provs if matchfunc(find, comparison))
+
+if __name__ == "__main__":
+    filename = os.path.join(os.path.dirname(__file__), "..", "pshapes_raw_auto.csv")
+    provs = load_provs(filename)[:1000]
+    assert compare_all(legacy_ids_equal, provs) == compare_all(ids_equal, provs)
+
+    print "%s provinces, %s comparisons per run" % (len(provs), len(provs)**2)
+    legacy = min(timeit.repeat(lambda: compare_all(legacy_ids_equal, provs), number=1, repeat=3))
+    print "legacy ids_equal: %.3f s" % legacy
+    memoized = min(timeit.repeat(lambda: compare_all(ids_equal, provs), number=1, repeat=3))
+    print "memoized ids_equal: %.3f s" % memoized
+    print "speedup: %.1fx" % (legacy / memoized)
@@ -0,0 +1,66 @@
+# -*- coding: utf8 -*-
+
+# Peak memory of holding many provinces, comparing the previous Province
+# (plain attributes and nested GeoJSON geometry dicts) with the current one.
+# Uses the transfer geometries in the bundled change table as province
+# geometries, repeated to reach a realistic global number of provinces.
+# Each variant is run in a separate process, so peak RSS is not shared.
+# Run with: python benchmarks/bench_province_memory.py
+
+import os
+import sys
+import csv
+import resource
+import multiprocessing
+
+# run as a script, so make the pshapes package in the repository root importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pshapes.process import Province, parse_cutpoly
+
+COPIES = 20
+
+class LegacyProvince:
+    def __init__(self, country, start, end, ids, other, geometry):
+        self.country = country
+        self.start = start
+        self.end = end
+        self.ids = ids
+        self.other = other
+        self.geometry = geometry
+
+def load_rows(filename):
+    with open(filename, "rb") as reader:
+        rows = [row for row in csv.DictReader(reader) if row["transfer_geom"]]
+    return rows
+
+def hold(args):
+    cls,filename = args
+    rows = load_rows(filename)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    provs = []
+    for _ in range(COPIES):
+        for row in rows:
+            # decode strings per copy, as they would be when read from a file
+            geom = parse_cutpoly(row["transfer_geom"]).__geo_interface__
+            provs.append(cls(country=row["tocountry"].decode("utf8"),
+                             start=None,
+                             end=None,
+                             ids={"Name": row["toname"].decode("utf8"),
+                                  "Alterns": [alt.decode("utf8") for alt in row["toalterns"].split("|")] if row["toalterns"] else [],
+                                  "HASC": row["tohasc"].decode("utf8") or None,
+                                  "ISO": row["toiso"].decode("utf8") or None,
+                                  "FIPS": row["tofips"].decode("utf8") or None},
+                             other={"Type": row["totype"].decode("utf8") or None,
+                                    "Capital": None},
+                             geometry=geom))
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return len(provs), (after - before) / 1024.0
+
+if __name__ == "__main__":
+    filename = os.path.join(os.path.dirname(__file__), "..", "pshapes_raw_auto.csv")
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    for label,cls in (("legacy Province",LegacyProvince), ("Province",Province)):
+        count,peak = pool.apply(hold, [(cls,filename)])
+        print "%s: %s provinces, peak RSS increase %.1f MB" % (label, count, peak)
+    pool.close()
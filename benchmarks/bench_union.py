@@ -0,0 +1,66 @@
+# -*- coding: utf8 -*-
+
+# Compares the union strategies of geomops.union_parts, and the old cascaded_union,
+# for reassembling provinces from their parts.
+# Uses the real events of the bundled change table: the cutpolys given away by each fromprov
+# in an event are used to cut a province (the slightly buffered union of those cutpolys),
+# and the resulting non-overlapping parts are unioned back together. 
+# Run with: python benchmarks/bench_union.py
+
+import os
+import sys
+import csv
+import timeit
+import warnings
+import shapely, shapely.ops
+
+# run as a script, so make the pshapes package in the repository root importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pshapes.process import parse_cutpoly
+from pshapes.geomops import union_parts, union_strategies, vertex_count
+
+def load_partlists(filename):
+    groups = dict()
+    with open(filename, "rb") as reader:
+        for row in csv.DictReader(reader):
+            if row["transfer_geom"] and row["status"] != "NonActive":
+                key = (row["date"], row["fromcountry"], row["fromname"])
+                groups.setdefault(key, []).append(parse_cutpoly(row["transfer_geom"]))
+    partlists = []
+    for key in sorted(groups):
+        cutpolys = groups[key]
+        geom = shapely.ops.unary_union(cutpolys).buffer(0.01)
+        # cut one cutpoly at a time, like ResultsTable.cut
+        parts = []
+        for cutpoly in cutpolys:
+            parts.append(geom.intersection(cutpoly))
+            geom = geom.difference(cutpoly)
+        parts = [part for part in parts + [geom] if not part.is_empty and "Polygon" in part.geom_type]
+        if len(parts) > 1:
+            partlists.append(parts)
+    return partlists
+
+def cascaded(partlists):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return [shapely.ops.cascaded_union(parts) for parts in partlists]
+
+if __name__ == "__main__":
+    filename = os.path.join(os.path.dirname(__file__), "..", "pshapes_raw_auto.csv")
+    partlists = load_partlists(filename)
+    print "%s provinces from %s parts, %s vertices, shapely %s" % (len(partlists),
+                                                                   sum(len(parts) for parts in partlists),
+                                                                   sum(vertex_count(part) for parts in partlists for part in parts),
+                                                                   shapely.__version__)
+
+    if hasattr(shapely.ops, "cascaded_union"):
+        secs = min(timeit.repeat(lambda: cascaded(partlists), number=1, repeat=3))
+        print "cascaded_union: %.3f s" % secs
+    reference = [union_parts(parts, "unary") for parts in partlists]
+    for strategy in sorted(union_strategies):
+        secs = min(timeit.repeat(lambda: [union_parts(parts, strategy) for parts in partlists], number=1, repeat=3))
+        unioned = [union_parts(parts, strategy) for parts in partlists]
+        maxdiff = max(abs(a.area - b.area) for a,b in zip(unioned, reference))
+        invalid = len([geom for geom in unioned if not geom.is_valid])
+        print "%s: %.3f s (max area difference %.8f, %s invalid)" % (strategy, secs, maxdiff, invalid)
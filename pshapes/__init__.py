@@ -1,6 +1,15 @@
 
+__version__ = "0.1.0"
+
+import logging
+# quiet unless the application configures logging,
+# eg logging.basicConfig(level=logging.INFO), or DEBUG for every event and change
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
 from .prep import CurrentBoundaries, ChangeData
 from .main import build
 
 
 
+from .timeline import Timeline
+from .binary import BinaryReader
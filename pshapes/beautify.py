@@ -0,0 +1,215 @@
+# -*- coding: utf8 -*-
+
+"""
+Post-processing of the output province geometries, ie removing slivers and simplifying.
+This used to be the slowest geometry step of a build, so the strategy can be chosen:
+
+- "none": no cleaning at all.
+- "sliver": drops holes and parts below an area threshold, then simplifies. Fast.
+- "buffer": buffers out and in to fill hole slivers, then in and out to strip island slivers, then simplifies. Slow.
+- "deferred": runs another strategy (by default "buffer") once at the end of backtracking, instead of as each province is added.
+
+Each strategy keeps the time spent on each province in its timings list.
+"""
+
+import time
+import copy
+import logging
+import shapely, shapely.geometry
+
+logger = logging.getLogger(__name__)
+
+
+class Beautifier:
+    name = None
+    
+    def __init__(self):
+        self.timings = []
+
+    def __call__(self, geom, prov):
+        "Returns the cleaned geom, or None if nothing should be added"
+        t = time.time()
+        geom = self.clean(geom)
+        self.timings.append((prov.country, prov.ids["Name"], time.time() - t))
+        return geom
+
+    def clean(self, geom):
+        "Returns the cleaned geom, the base class leaves it as it is"
+        return geom
+
+    def added(self, prov):
+        "Called with each province added after cleaning"
+        pass
+
+    def copied(self, pairs):
+        "Called with (source, copy) pairs of provinces added with the geometry of an existing one, eg by * changes"
+        pass
+
+    def finalize(self, table):
+        "Called once with the ResultsTable at the end of backtracking"
+        pass
+
+    def config(self):
+        "Name and options, eg to tell if cached results were made the same way"
+        options = [(k, v.config() if isinstance(v, Beautifier) else v)
+                   for k,v in sorted(vars(self).items())
+                   if k not in ("timings","pending")]
+        return (self.name, options)
+
+    def copy(self):
+        "Same strategy and options, but without any timings, eg for separate ResultsTables"
+        new = copy.copy(self)
+        new.timings = []
+        return new
+
+    def report(self, slowest=10):
+        secs = [t for _,_,t in self.timings]
+        total = sum(secs)
+        return {"strategy": self.name,
+                "provinces": len(secs),
+                "total": total,
+                "mean": total / len(secs) if secs else 0,
+                "max": max(secs) if secs else 0,
+                "slowest": sorted(self.timings, key=lambda item: -item[2])[:slowest]}
+
+    def summary(self):
+        report = self.report(slowest=3)
+        lines = ["beautify (%s): %s provinces in %.2f s, mean %.4f s, max %.4f s" % (report["strategy"], report["provinces"], report["total"], report["mean"], report["max"])]
+        for country,name,secs in report["slowest"]:
+            lines.append("    %.4f s: %s, %s" % (secs, name.encode("utf8"), country.encode("utf8")))
+        return "\n".join(lines)
+
+class NoBeautifier(Beautifier):
+    name = "none"
+
+class SliverBeautifier(Beautifier):
+    name = "sliver"
+    
+    def __init__(self, minarea=0.0000001, tolerance=0.0001):
+        Beautifier.__init__(self)
+        self.minarea = minarea
+        self.tolerance = tolerance
+
+    def clean(self, geom):
+        if geom.geom_type == "Polygon":
+            polys = [geom]
+        elif geom.geom_type == "MultiPolygon":
+            polys = list(geom.geoms)
+        else:
+            return geom
+        cleaned = []
+        for poly in polys:
+            # strip away island slivers
+            if poly.area < self.minarea:
+                continue
+            # fill in hole slivers
+            holes = [hole for hole in poly.interiors
+                     if shapely.geometry.Polygon(hole).area >= self.minarea]
+            cleaned.append(shapely.geometry.Polygon(poly.exterior, holes))
+        if not cleaned:
+            logger.debug("skipping tiny island sliver")
+            return None
+        elif len(cleaned) == 1:
+            geom = cleaned[0]
+        else:
+            geom = shapely.geometry.MultiPolygon(cleaned)
+        if self.tolerance:
+            try:
+                geom = geom.simplify(self.tolerance, preserve_topology=True)  # reduce filesize
+            except:
+                logger.warning("simplify failed")
+        return geom
+
+class BufferBeautifier(Beautifier):
+    name = "buffer"
+    
+    def __init__(self, distance=0.00001, tolerance=0.0001):
+        Beautifier.__init__(self)
+        self.distance = distance
+        self.tolerance = tolerance
+
+    def clean(self, fullgeom):
+        # WARNING: SLOW!
+        try:
+            fixed = fullgeom.buffer(self.distance).buffer(-self.distance) # fill in hole slivers
+            if fixed.is_valid:
+                fullgeom = fixed
+        except:
+            logger.warning("hole slivers failed")
+            pass
+        try:
+            fixed = fullgeom.buffer(-self.distance).buffer(self.distance) # strip away island slivers
+            if fixed.is_empty:
+                logger.debug("skipping tiny island sliver")
+                return None
+            if fixed.is_valid:
+                fullgeom = fixed
+        except:
+            logger.warning("island slivers failed")
+            pass
+        if self.tolerance:
+            try:
+                fullgeom = fullgeom.simplify(self.tolerance, preserve_topology=True)  # reduce filesize
+            except:
+                logger.warning("simplify failed")
+                pass
+        return fullgeom
+
+class DeferredBeautifier(Beautifier):
+    name = "deferred"
+    
+    def __init__(self, strategy=None):
+        Beautifier.__init__(self)
+        self.strategy = get_beautifier(strategy or "buffer")
+        self.pending = []
+
+    def __call__(self, geom, prov):
+        return geom
+
+    def added(self, prov):
+        self.pending.append(prov)
+
+    def copied(self, pairs):
+        # the copies get the same cleaning as their source, as when they share its already cleaned geometry
+        pending = set(id(prov) for prov in self.pending)
+        self.pending.extend(copy for source,copy in pairs if id(source) in pending)
+
+    def finalize(self, table):
+        logger.info("beautifying %s provinces", len(self.pending))
+        dropped = set()
+        for prov in self.pending:
+            geom = self.strategy(prov.shape, prov)
+            if geom is None or geom.is_empty:
+                dropped.add(id(prov))
+            else:
+                prov.shape = geom
+        self.timings.extend(self.strategy.timings)
+        self.strategy.timings = []
+        self.pending = []
+        if dropped:
+            table.provs = [prov for prov in table.provs if id(prov) not in dropped]
+            table.reindex()
+
+    def copy(self):
+        new = Beautifier.copy(self)
+        new.strategy = self.strategy.copy()
+        new.pending = []
+        return new
+
+    def report(self, slowest=10):
+        report = Beautifier.report(self, slowest)
+        report["strategy"] = "deferred %s" % self.strategy.name
+        return report
+
+strategies = {"none": NoBeautifier,
+              "sliver": SliverBeautifier,
+              "buffer": BufferBeautifier,
+              "deferred": DeferredBeautifier}
+
+def get_beautifier(strategy):
+    "Strategy instance from a name, or passes through an existing instance"
+    if isinstance(strategy, Beautifier):
+        return strategy
+    if strategy not in strategies:
+        raise Exception("Unknown beautify strategy %s, must be one of %s" % (strategy, ", ".join(sorted(strategies))))
+    return strategies[strategy]()
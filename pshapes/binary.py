@@ -0,0 +1,147 @@
+# -*- coding: utf8 -*-
+
+"""
+Compact binary format for the final province data, written by build() to .pshp files,
+and read through mmap so that many processes share the same pages, and features
+are only decoded when accessed.
+
+All numbers are little-endian. The file consists of:
+- header: magic, version, number of columns and features, and the offsets of the sections below
+- column definitions: the name (as a string number) and type of each column
+- column data: for each column, one fixed-width 4 byte value per feature,
+  a string number for text and list columns (NULL if missing), or a day ordinal for dates (0 if missing)
+- string table: the number of strings, their start and end offsets, and the utf8 text,
+  where each distinct string is only stored once
+- geometries: the start and end offsets of each feature's WKB, and the WKB itself,
+  with the same start and end for a missing geometry
+"""
+
+import struct
+import mmap
+import datetime
+import shapely, shapely.wkb
+
+
+MAGIC = b"PSHP"
+VERSION = 1
+# magic, version, columns, features, and offsets of column data, string table, geometry offsets, geometries
+HEADER = struct.Struct("<4sHHIQQQQ")
+# name string, type
+COLUMN = struct.Struct("<IB")
+# column types
+TEXT, DATE, LIST = 0, 1, 2
+NULL = 0xFFFFFFFF
+LIST_SEPARATOR = "|"
+
+
+class BinaryReader:
+    """
+    Memory mapped reader of a .pshp file, supporting len(), indexing, and iteration of features.
+    Strings are decoded once and then cached, everything else is decoded on each access.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, ncolumns, self.nfeatures, self._data, strings, geomoffsets, self._geoms = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise Exception("%s is not a pshapes binary file" % filename)
+        if version > VERSION:
+            raise Exception("%s is a newer version %s of the pshapes binary format, can only read up to %s" % (filename, version, VERSION))
+        self._geomoffsets = geomoffsets
+        nstrings = struct.unpack_from("<I", self.mm, strings)[0]
+        self._stringoffsets = strings + 4
+        self._stringdata = self._stringoffsets + 8 * (nstrings + 1)
+        self._strings = dict()
+        self.columns = []
+        self.types = []
+        for c in range(ncolumns):
+            name, typ = COLUMN.unpack_from(self.mm, HEADER.size + c * COLUMN.size)
+            self.columns.append(self.string(name))
+            self.types.append(typ)
+        self._columnpos = dict((name,c) for c,name in enumerate(self.columns))
+
+    def __len__(self):
+        return self.nfeatures
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.nfeatures
+        if not 0 <= i < self.nfeatures:
+            raise IndexError("Feature index out of range")
+        return BinaryFeature(self, i)
+
+    def __iter__(self):
+        for i in range(self.nfeatures):
+            yield BinaryFeature(self, i)
+
+    def string(self, k):
+        "String number k of the string table, or None for NULL"
+        if k == NULL:
+            return None
+        if k not in self._strings:
+            start, end = struct.unpack_from("<QQ", self.mm, self._stringoffsets + 8 * k)
+            self._strings[k] = self.mm[self._stringdata + start:self._stringdata + end].decode("utf8")
+        return self._strings[k]
+
+    def value(self, i, column):
+        "Value of a column, given by name or number, for feature i"
+        c = self._columnpos[column] if not isinstance(column, int) else column
+        typ = self.types[c]
+        pos = self._data + 4 * (c * self.nfeatures + i)
+        if typ == DATE:
+            ordinal = struct.unpack_from("<i", self.mm, pos)[0]
+            return datetime.date.fromordinal(ordinal) if ordinal else None
+        val = self.string(struct.unpack_from("<I", self.mm, pos)[0])
+        if typ == LIST:
+            return val.split(LIST_SEPARATOR) if val else []
+        return val
+
+    def column(self, column):
+        "All values of a column, given by name or number"
+        return [self.value(i, column) for i in range(self.nfeatures)]
+
+    def properties(self, i):
+        return dict((name, self.value(i, c)) for c,name in enumerate(self.columns))
+
+    def wkb(self, i):
+        "WKB bytes of feature i, or None"
+        start, end = struct.unpack_from("<QQ", self.mm, self._geomoffsets + 8 * i)
+        if start != end:
+            return self.mm[self._geoms + start:self._geoms + end]
+
+    def geometry(self, i):
+        "Shapely geometry of feature i, or None"
+        wkb = self.wkb(i)
+        if wkb is not None:
+            return shapely.wkb.loads(wkb)
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+class BinaryFeature(object):
+    "Lazy view of one feature in a BinaryReader"
+    __slots__ = ("reader", "index")
+
+    def __init__(self, reader, index):
+        self.reader = reader
+        self.index = index
+
+    def __getitem__(self, name):
+        return self.reader.value(self.index, name)
+
+    @property
+    def properties(self):
+        return self.reader.properties(self.index)
+
+    @property
+    def geometry(self):
+        return self.reader.geometry(self.index)
+
+    @property
+    def __geo_interface__(self):
+        geometry = self.geometry
+        return {"type": "Feature",
+                "properties": self.properties,
+                "geometry": geometry.__geo_interface__ if geometry is not None else None}
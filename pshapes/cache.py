@@ -0,0 +1,160 @@
+# -*- coding: utf8 -*-
+
+"""
+On-disk caches, so that repeated builds can skip work whose inputs did not change.
+"""
+
+import os
+import hashlib
+import pickle
+import zlib
+import shapely, shapely.wkb
+
+from .process import parse_cutpoly
+
+
+def content_hash(text):
+    if not isinstance(text, bytes):
+        text = text.encode("utf8")
+    return hashlib.sha1(text).hexdigest()
+
+def _dump(obj, filename, compress=False):
+    # write to temporary file first, so a crash never leaves a half written cache
+    tempname = filename + ".tmp"
+    with open(tempname, "wb") as writer:
+        if compress:
+            writer.write(zlib.compress(pickle.dumps(obj, 2)))
+        else:
+            pickle.dump(obj, writer, 2)
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tempname, filename)
+
+class CutpolyCache:
+    """
+    Parsed cutpolys stored as WKB, keyed on a hash of the raw transfer_geom text.
+    Without a filename it only avoids parsing the same text twice within a build.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.wkbs = dict()
+        self.changed = False
+        if filename and os.path.exists(filename):
+            with open(filename, "rb") as reader:
+                self.wkbs = pickle.load(reader)
+
+    def get(self, raw):
+        key = content_hash(raw)
+        wkb = self.wkbs.get(key)
+        if wkb is None:
+            geom = parse_cutpoly(raw)
+            self.wkbs[key] = geom.wkb
+            self.changed = True
+        else:
+            geom = shapely.wkb.loads(wkb)
+        return geom
+
+    def save(self):
+        if self.filename and self.changed:
+            _dump(self.wkbs, self.filename)
+            self.changed = False
+
+def _ids_repr(prov):
+    return repr((prov.country, sorted(prov.ids.items()), sorted(prov.other.items())))
+
+def table_hash(table, version):
+    """
+    Hash of everything that goes into backtracking a ResultsTable:
+    its current provs, its events, the matching, union and beautification options, and the pshapes version.
+    """
+    hsh = hashlib.sha1()
+    union = getattr(table.union, "__name__", table.union)
+    hsh.update(repr((version, table.matchfunc.__name__, table.maxdate, table.beautifier.config(), union)))
+    for prov in table.provs:
+        hsh.update(_ids_repr(prov))
+        hsh.update(repr((prov.start, prov.end)))
+        # the stored WKB, so the geometry is not decoded just to be encoded again
+        hsh.update(prov._wkb)
+    for event in table.events:
+        hsh.update(repr(event.date))
+        for change in event.changes:
+            hsh.update(change.type)
+            hsh.update(_ids_repr(change.fromprov))
+            hsh.update(_ids_repr(change.toprov))
+            if hasattr(change, "cutpoly"):
+                hsh.update(change.cutpoly.wkb)
+    return hsh.hexdigest()
+
+class ResultCache:
+    """
+    Backtracked provs of independent ResultsTables (see ResultsTable.partition),
+    one file each, keyed on the hash of their inputs.
+    """
+    def __init__(self, directory, version):
+        self.directory = directory
+        self.version = version
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def key(self, table):
+        return table_hash(table, self.version)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def get(self, key):
+        "Cached provs, or None"
+        path = self._path(key)
+        if os.path.exists(path):
+            with open(path, "rb") as reader:
+                return pickle.load(reader)
+
+    def put(self, key, provs):
+        _dump(provs, self._path(key))
+
+class Checkpoints:
+    """
+    Periodic snapshots of ResultsTables while backtracking, so a long run that crashed
+    can resume where it stopped instead of starting over (see ResultsTable.begin_backtracking).
+    One zlib compressed pickle per table, keyed on the hash of its inputs, with the provs so far,
+    the number of events done, and the diagnostics failures so far.
+    Saved every n events, and whenever the events reach a new decade.
+    A table's checkpoint is removed once it finishes.
+    """
+    def __init__(self, directory, version, every=100, resume=False):
+        if every < 1:
+            raise Exception("Checkpoints must be saved every 1 or more events, not %s" % every)
+        self.directory = directory
+        self.version = version
+        self.every = every
+        # otherwise existing checkpoints are ignored, and overwritten
+        self.resume = resume
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def key(self, table):
+        return table_hash(table, self.version)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".checkpoint")
+
+    def due(self, done, events):
+        "Whether to save after the first done events, in backtracking order"
+        if done >= len(events):
+            return False
+        return done % self.every == 0 or events[done].date.year // 10 != events[done-1].date.year // 10
+
+    def load(self, key):
+        "The saved state, or None if not resuming or no checkpoint"
+        path = self._path(key)
+        if self.resume and os.path.exists(path):
+            with open(path, "rb") as reader:
+                return pickle.loads(zlib.decompress(reader.read()))
+
+    def save(self, key, state):
+        _dump(state, self._path(key), compress=True)
+
+    def remove(self, key):
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(path)
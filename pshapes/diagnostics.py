@@ -0,0 +1,140 @@
+# -*- coding: utf8 -*-
+
+"""
+Diagnostics of the problems found while backtracking, eg a cutpoly that doesn't overlap its province.
+Each failure can be written to a bundle in a diagnostics directory:
+a GeoJSON file with the geometries involved and the change metadata,
+and optionally a PNG map rendered off-screen with pythongis (which must then be installed).
+A manifest.json lists all failures of the run.
+
+The policy decides what happens next:
+- "raise": stop the build with a DiagnosticsError, same as before.
+- "continue": skip the failing change or province, and keep going, so all failures of a run are collected.
+- "isolate": stop only the group of linked countries where it happened, and leave that group out of the output
+  (see ResultsTable.begin_backtracking_partitioned). The group is also listed,
+  as a failure of kind "component" with the error and traceback.
+"""
+
+import os
+import re
+import json
+import logging
+import shapely, shapely.geometry
+
+logger = logging.getLogger(__name__)
+
+
+class DiagnosticsError(Exception):
+    def __init__(self, message, failure=None):
+        Exception.__init__(self, message)
+        self.failure = failure
+
+def _json_value(val):
+    if isinstance(val, dict):
+        return dict((k, _json_value(v)) for k,v in val.items())
+    elif isinstance(val, (list,tuple)):
+        return [_json_value(v) for v in val]
+    elif val is None or isinstance(val, (basestring,int,float,bool)):
+        return val
+    else:
+        return str(val)
+
+class Diagnostics:
+    policies = ("raise", "continue", "isolate")
+
+    def __init__(self, directory=None, policy="raise", render=False):
+        if policy not in self.policies:
+            raise Exception("Unknown diagnostics policy %s, must be one of %s" % (policy, ", ".join(self.policies)))
+        self.directory = directory
+        self.policy = policy
+        self.render = render
+        self.failures = []
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def copy(self):
+        "Same settings but no failures, eg for a partitioned table"
+        return Diagnostics(self.directory, self.policy, self.render)
+
+    def failure(self, kind, message, layers=(), **metadata):
+        """
+        Record a failure, with layers as a list of (name, shapely geometry) pairs to show, and any metadata.
+        Raises a DiagnosticsError unless the policy is continue, otherwise logs it and returns.
+        """
+        failure = self.record(kind, message, layers, **metadata)
+        if self.policy != "continue":
+            raise DiagnosticsError(message, failure)
+        logger.warning("%s, continuing", message)
+
+    def record(self, kind, message, layers=(), **metadata):
+        "Same as failure, but regardless of the policy, and returns the failure"
+        failure = {"kind": kind, "message": message, "files": []}
+        failure.update(_json_value(metadata))
+        if self.directory and layers:
+            name = "%s_%s" % (len(self.failures) + 1, kind)
+            if metadata.get("country"):
+                name = "%s_%s" % (metadata["country"], name)
+            if metadata.get("date"):
+                name = "%s_%s" % (metadata["date"], name)
+            name = re.sub(r"[^\w\-]+", "_", name.encode("ascii", "replace") if isinstance(name, unicode) else name)
+            failure["files"].append(self._write_geojson(name, layers, failure))
+            if self.render:
+                png = self._write_png(name, layers, message)
+                if png:
+                    failure["files"].append(png)
+        self.failures.append(failure)
+        return failure
+
+    def _write_geojson(self, name, layers, failure):
+        filename = name + ".geojson"
+        properties = dict((k,v) for k,v in failure.items() if k != "files")
+        features = []
+        for layername,geom in layers:
+            if geom is None:
+                continue
+            props = dict(properties)
+            props["layer"] = layername
+            features.append({"type": "Feature",
+                             "properties": props,
+                             "geometry": shapely.geometry.mapping(geom)})
+        with open(os.path.join(self.directory, filename), "wb") as writer:
+            json.dump({"type": "FeatureCollection", "features": features}, writer)
+        return filename
+
+    def _write_png(self, name, layers, title):
+        # same map as the old popups, but saved instead of shown
+        try:
+            import pythongis as pg
+            mapp = pg.renderer.Map(500, 500, title=title[:80])
+            colors = ["red", "blue", "green", "orange"]
+            for i,(layername,geom) in enumerate(layers):
+                if geom is None or geom.is_empty:
+                    continue
+                dat = pg.VectorData(type="Polygon")
+                dat.fields = ["Text"]
+                dat.add_feature([layername], geom.__geo_interface__)
+                mapp.add_layer(dat, fillcolor=pg.renderer.rgb(colors[i % len(colors)]), legendoptions=dict(title=layername))
+            mapp.add_legend(xy=("99%w","99%h"), anchor="se")
+            mapp.zoom_bbox(*mapp.layers.bbox)
+            mapp.zoom_out(2)
+            filename = name + ".png"
+            mapp.save(os.path.join(self.directory, filename))
+            return filename
+        except Exception as err:
+            logger.warning("could not render diagnostics map %s: %s", name, err)
+
+    def merge(self, failures):
+        "Add the failures collected elsewhere, eg in a worker process"
+        self.failures.extend(failures)
+
+    def save_manifest(self):
+        "Write manifest.json listing all failures, if there is a directory"
+        if self.directory:
+            with open(os.path.join(self.directory, "manifest.json"), "wb") as writer:
+                json.dump({"policy": self.policy, "failures": self.failures}, writer, indent=4)
+
+    def summary(self):
+        kinds = dict()
+        for failure in self.failures:
+            kinds[failure["kind"]] = kinds.get(failure["kind"], 0) + 1
+        return "%s failures: %s" % (len(self.failures), ", ".join("%s %s" % (n, kind) for kind,n in sorted(kinds.items())))
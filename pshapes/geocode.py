@@ -0,0 +1,172 @@
+# -*- coding: utf8 -*-
+
+"""
+Bulk historical reverse geocoding, ie assigning lots of (lon, lat, date) points
+to the province that was valid at that place and time, using a Timeline.
+
+Points are grouped by the time slice of their date, so each slice's index
+is only built once and queried for all its points at a time. Slices with many points
+get a grid index, where most points fall in a cell that lies inside a single province,
+and are geocoded without making a shapely point.
+Chunks of points can also be geocoded in a pool of processes that each load the timeline once.
+
+Results are positions in timeline.provs, or -1 where no province was found.
+"""
+
+import csv
+import bisect
+import multiprocessing
+import shapely, shapely.geometry
+
+from .timeline import Timeline, parse_date
+from .spatial import GridIndex
+
+
+def _ordinals(dates):
+    "Day ordinals of dates given as date objects, strings or ordinals, with None if missing"
+    # the same dates tend to come up over and over, so only parse each once
+    parsed = dict()
+    ordinals = []
+    for date in dates:
+        if isinstance(date, (int,long)):
+            # already an ordinal
+            ordinals.append(date)
+            continue
+        if date not in parsed:
+            date_obj = parse_date(date)
+            parsed[date] = date_obj.toordinal() if date_obj else None
+        ordinals.append(parsed[date])
+    return ordinals
+
+def geocode(timeline, lons, lats, dates):
+    """
+    Position in timeline.provs of the province containing each point on its date, or -1.
+    Lons, lats and dates are sequences of the same length. Returns a list.
+    """
+    breaks = [date.toordinal() for date in timeline.changes()]
+    byslice = dict()
+    for i,ordinal in enumerate(_ordinals(dates)):
+        if ordinal is not None:
+            byslice.setdefault(bisect.bisect_right(breaks, ordinal), []).append(i)
+    results = [-1] * len(lons)
+    for k,positions in byslice.items():
+        index,prepared = timeline.slice_index(k)
+        items = index.items
+        if len(positions) >= GridIndex.density * len(index):
+            # enough points to pay for building the grid
+            lookup = timeline.slice_grid(k).lookup
+            for i in positions:
+                hit = lookup(lons[i], lats[i])
+                if isinstance(hit, int):
+                    results[i] = items[hit]
+                elif hit:
+                    point = shapely.geometry.Point(lons[i], lats[i])
+                    for j in hit:
+                        if prepared[j].intersects(point):
+                            results[i] = items[j]
+                            break
+        else:
+            for i in positions:
+                point = shapely.geometry.Point(lons[i], lats[i])
+                for j in index.query_positions(point):
+                    if prepared[j].intersects(point):
+                        results[i] = items[j]
+                        break
+    return results
+
+# each pool process loads its own timeline once
+
+_timeline = None
+
+def _init_worker(source):
+    global _timeline
+    _timeline = Timeline.from_geojson(source) if isinstance(source, basestring) else source
+
+def _geocode_chunk(chunk):
+    lons,lats,dates = chunk
+    return geocode(_timeline, lons, lats, dates)
+
+def geocode_parallel(source, lons, lats, dates, processes=None, chunksize=100000):
+    """
+    Same as geocode, but chunks of points are geocoded in a pool of processes
+    (defaults to the number of cpus, or 1 for no pool). Source is either a Timeline,
+    or preferably the filename of the GeoJSON written by build(), so each process loads it itself.
+    """
+    if processes == 1:
+        _init_worker(source)
+        return _geocode_chunked(map, lons, lats, dates, chunksize)
+    pool = multiprocessing.Pool(processes, _init_worker, (source,))
+    try:
+        return _geocode_chunked(pool.map, lons, lats, dates, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+def _geocode_chunked(mapfunc, lons, lats, dates, chunksize):
+    # points are sorted by date before chunking, so each process only needs the indexes of a few slices
+    ordinals = _ordinals(dates)
+    order = sorted(range(len(ordinals)), key=ordinals.__getitem__)
+    chunks = []
+    for start in range(0, len(order), chunksize):
+        positions = order[start:start+chunksize]
+        chunks.append(([lons[i] for i in positions], [lats[i] for i in positions], [ordinals[i] for i in positions]))
+    # back to the original order of the points
+    results = [-1] * len(order)
+    for start,chunkresult in zip(range(0, len(order), chunksize), mapfunc(_geocode_chunk, chunks)):
+        for i,result in zip(order[start:start+chunksize], chunkresult):
+            results[i] = result
+    return results
+
+def geocode_csv(source, infile, outfile, lonfield="lon", latfield="lat", datefield="date", processes=1, chunksize=100000):
+    """
+    Streams the points of a CSV file, and writes each row with the country, name and hasc
+    of its province added, or empty if not found. Source is the GeoJSON written by build(),
+    and infile and outfile are filenames or file objects. Rows are read and geocoded
+    one chunk at a time, so the file can be larger than memory.
+    """
+    timeline = Timeline.from_geojson(source)
+    # only close the files opened here
+    opened = []
+    if isinstance(infile, basestring):
+        infile = open(infile, "rb")
+        opened.append(infile)
+    if isinstance(outfile, basestring):
+        outfile = open(outfile, "wb")
+        opened.append(outfile)
+    reader = csv.DictReader(infile)
+    writer = csv.DictWriter(outfile, reader.fieldnames + ["prov_country","prov_name","prov_hasc"])
+    writer.writeheader()
+    def encode(val):
+        return val.encode("utf8") if isinstance(val, unicode) else val
+    workers = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers, _init_worker, (source,)) if workers > 1 else None
+    def write(rows):
+        lons = [float(row[lonfield]) for row in rows]
+        lats = [float(row[latfield]) for row in rows]
+        dates = [row[datefield] or None for row in rows]
+        if pool:
+            # spread each chunk of rows over all the processes
+            results = _geocode_chunked(pool.map, lons, lats, dates, len(rows) // workers + 1)
+        else:
+            results = geocode(timeline, lons, lats, dates)
+        for row,result in zip(rows, results):
+            prov = timeline.provs[result] if result >= 0 else None
+            row["prov_country"] = encode(prov.country) if prov else ""
+            row["prov_name"] = encode(prov.ids["Name"]) if prov else ""
+            row["prov_hasc"] = encode(prov.ids["HASC"] or "") if prov else ""
+            writer.writerow(row)
+    try:
+        rows = []
+        for row in reader:
+            rows.append(row)
+            if len(rows) == chunksize:
+                write(rows)
+                rows = []
+        if rows:
+            write(rows)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        for fileobj in opened:
+            fileobj.close()
@@ -0,0 +1,50 @@
+# -*- coding: utf8 -*-
+
+"""
+Geometry operations used during backtracking.
+
+union_parts reassembles a province from its parts with one of several union strategies.
+"""
+
+import shapely, shapely.ops, shapely.geometry
+
+
+def vertex_count(geom):
+    "Number of vertices in a polygon or multipolygon"
+    if geom.geom_type == "Polygon":
+        return len(geom.exterior.coords) + sum(len(ring.coords) for ring in geom.interiors)
+    elif hasattr(geom, "geoms"):
+        return sum(vertex_count(sub) for sub in geom.geoms)
+    else:
+        return 0
+
+def union_unary(geoms):
+    return shapely.ops.unary_union(geoms)
+
+def union_snap(geoms, tolerance=0.000001):
+    "Snaps all parts to the largest one before union, so near coincident edges dont leave slivers"
+    largest = max(geoms, key=lambda geom: geom.area)
+    snapped = [geom if geom is largest else shapely.ops.snap(geom, largest, tolerance) for geom in geoms]
+    return union_unary(snapped)
+
+def union_auto(geoms):
+    """
+    The default strategy, currently plain unary union.
+    Snapping moves vertices, so it is only used when asked for.
+    """
+    return union_unary(geoms)
+
+union_strategies = {"unary": union_unary,
+                    "snap": union_snap,
+                    "auto": union_auto}
+
+def union_parts(geoms, strategy="auto"):
+    "Union of a list of geometries, with one of the strategies in union_strategies, or a custom function"
+    geoms = list(geoms)
+    if len(geoms) == 1:
+        return geoms[0]
+    if not hasattr(strategy, "__call__"):
+        if strategy not in union_strategies:
+            raise Exception("Unknown union strategy %s, must be one of %s" % (strategy, ", ".join(sorted(union_strategies))))
+        strategy = union_strategies[strategy]
+    return strategy(geoms)
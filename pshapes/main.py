@@ -1,7 +1,9 @@
 
+import os
 import itertools
 import datetime
 import warnings
+import logging
 import dateutil, dateutil.parser
 import pygeoj
 import shapely, shapely.ops, shapely.geometry
@@ -9,111 +11,110 @@ from unidecode import unidecode
 
 from .process import *
 from .prep import *
+from .cache import CutpolyCache, ResultCache, Checkpoints
+from . import __version__
+from .output import open_writer
+from .profiling import Profiler
+from .diagnostics import Diagnostics
 
-import pythongis as pg
+logger = logging.getLogger(__name__)
 
 ########################
 
-def build(currentboundaries, changedata, outfile):
+def build(currentboundaries, changedata, outfile, partitioned=False, processes=None, cachedir=None, precision=None, beautify="buffer", union="auto", incremental=False, profile=None,
+          diagnostics=None, on_failure="raise", render_diagnostics=False,
+          checkpoints=None, checkpoint_every=100, resume=False):
+    """
+    Backtracks the current boundaries through the change data, and writes the resulting provinces to outfile,
+    in the format given by its extension (see output.py).
+    Returns the backtracked ResultsTable. This used to be the output as a pygeoj GeojsonFile,
+    which can still be had with pygeoj.load(outfile) when writing GeoJSON.
+    """
     curtable = currentboundaries
     eventstable = changedata
 
+    # cache parsed cutpolys between builds
+    if cachedir and not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    cutpolys = CutpolyCache(os.path.join(cachedir, "cutpolys.cache") if cachedir else None)
+
     # initiate results with events from changedata
-    results = ResultsTable()
-    for date,changetable in eventstable.data.manage.split("date"):
+    # timings of each stage, event and country group (see profiling.py),
+    # printed at the end, and also saved as JSON if profile is a filename
+    profiler = Profiler() if profile else None
+    # failures are written to the diagnostics directory, if any,
+    # and either stop the build, are skipped, or stop only their group of countries, depending on on_failure (see diagnostics.py)
+    diag = Diagnostics(diagnostics, policy=on_failure, render=render_diagnostics)
+    # backtracking state is saved to the checkpoints directory, if any, every checkpoint_every events and every decade,
+    # and with resume=True a run continues from the last checkpoint of the same inputs
+    if resume and not checkpoints:
+        raise Exception("Resuming requires a checkpoints directory")
+    checkpointer = Checkpoints(checkpoints, __version__, checkpoint_every, resume) if checkpoints else None
+    results = ResultsTable(beautify=beautify, union=union, profiler=profiler, diagnostics=diag, checkpoints=checkpointer)
+    readspan = results.profiler.span("read changes")
+    unknown = dict()
+    for date,rows in eventstable.events():
         event = Event()
-
-        # parse date correctly
-        date = dateutil.parser.parse(date)
-        event.date = datetime.date(year=date.year, month=date.month, day=date.day)
+        event.date = date
         
-        for row in changetable:
-
-            # remove junk tably.<None> obj
-            def parseval(val):
-                if not val or val == "X": return None
-                else: return val
-            for i,val in enumerate(row):
-                row[i] = parseval(val)
+        for row in rows:
+            if row.type not in change_types:
+                unknown[row.type] = unknown.get(row.type, 0) + 1
+                continue
 
             # create id dicts
-            fromprov = Province(country=row["fromcountry"],
+            fromprov = Province(country=row.fromcountry,
                                 start=None,
                                 end=None,
-                                ids={"Name":row["fromname"].strip(),
-                                     "Alterns":[alt.strip() for alt in row["fromalterns"].split("|")] if row["fromalterns"] else [],
-                                    "HASC":row["fromhasc"],
-                                    "ISO":row["fromiso"],
-                                    "FIPS":row["fromfips"]},
-                                other={"Type":row["fromtype"],
-                                       "Capital":row["fromcapital"]},
+                                ids={"Name":row.fromname,
+                                     "Alterns":row.fromalterns,
+                                    "HASC":row.fromhasc,
+                                    "ISO":row.fromiso,
+                                    "FIPS":row.fromfips},
+                                other={"Type":row.fromtype,
+                                       "Capital":row.fromcapital},
                                 geometry=None)
                                 
-            toprov = Province(country=row["tocountry"],
+            toprov = Province(country=row.tocountry,
                                 start=None,
                                 end=None,
-                                ids={"Name":row["toname"].strip(),
-                                     "Alterns":[alt.strip() for alt in row["toalterns"].split("|")] if row["toalterns"] else [],
-                                     "HASC":row["tohasc"],
-                                     "ISO":row["toiso"],
-                                     "FIPS":row["tofips"]},
-                                other={"Type":row["totype"],
-                                       "Capital":row["tocapital"]},
+                                ids={"Name":row.toname,
+                                     "Alterns":row.toalterns,
+                                     "HASC":row.tohasc,
+                                     "ISO":row.toiso,
+                                     "FIPS":row.tofips},
+                                other={"Type":row.totype,
+                                       "Capital":row.tocapital},
                                 geometry=None)
             
-            if row["Type".lower()] == "MergeNew":
-                if not row["transfer_geom"]: #or not row["FromHASC"]:
-                    continue
-                change = MergeNewChange(fromprov,
-                                            toprov,
-                                            row["transfer_geom"])
-            elif row["Type".lower()] in "MergeExisting FullTransfer":
-                if not row["transfer_geom"]: #or not row["FromHASC"]:
-                    continue
-                change = MergeExistingChange(fromprov,
-                                            toprov,
-                                            row["transfer_geom"])
-            elif row["Type".lower()] == "TransferNew":
-                if not row["transfer_geom"]: #or not row["FromHASC"]:
-                    continue
-                change = TransferNewChange(fromprov,
-                                            toprov,
-                                            row["transfer_geom"])
-            elif row["Type".lower()] in "TransferExisting PartTransfer":
-                if not row["transfer_geom"]: #or not row["FromHASC"]:
+            changeclass,needscutpoly = change_types[row.type]
+            if needscutpoly:
+                if not row.transfer_geom: #or not row["FromHASC"]:
                     continue
-                change = TransferExistingChange(fromprov,
-                                            toprov,
-                                            row["transfer_geom"])
-            elif row["Type".lower()] == "Breakaway":
-                change = BreakawayChange(fromprov,
-                                         toprov)
-            elif row["Type".lower()] == "SplitPart":
-                change = SplitPartChange(fromprov,
-                                         toprov)
-            elif row["Type".lower()] == "NewInfo":
-                change = NewInfoChange(fromprov,
-                                     toprov)
-            elif row["Type".lower()] == "Begin":
-                change = BeginChange(fromprov,
-                                     toprov)
+                change = changeclass(fromprov,
+                                     toprov,
+                                     cutpolys.get(row.transfer_geom))
             else:
-                continue
-            print row["Type".lower()]
+                change = changeclass(fromprov,
+                                     toprov)
+            logger.debug("%s", row.type)
             event.changes.append(change)
         results.add_event(event)
+    cutpolys.save()
+    readspan.stop()
+    if unknown:
+        warnings.warn("Skipped changes of unknown type, see process.register_change_type: %s"
+                      % ", ".join("%s (%s rows)" % (typename, count) for typename,count in sorted(unknown.items())))
     
     # get relevant countries from the change data
-    countries = set()
-    for f in eventstable.data:
-        countries.add(f["fromcountry"])
-        countries.add(f["tocountry"])
+    countries = eventstable.countries()
 
     # limit to only those countries
+    readspan = results.profiler.span("read current")
     curtable.data = curtable.data.select(lambda f: f[curtable.countryfield] in countries)
 
     # add current to results
-    print 'adding current to results'
+    logger.info("adding current to results")
     for feat in curtable.data:
         # add
         results.add_province(country=feat[curtable.countryfield],
@@ -129,23 +130,53 @@ def build(currentboundaries, changedata, outfile):
                                     "Capital": feat[curtable.subcapitalfield] if curtable.subcapitalfield and feat[curtable.subcapitalfield] else None},
                              geometry=feat.geometry)
 
+    readspan.stop()
+
     # begin backtracking
-    print 'beginning backtracking'
-    results.begin_backtracking()
+    # with on_failure="isolate" each group of linked countries is backtracked on its own,
+    # and a group that fails is left out of the output and listed in the diagnostics manifest
+    isolate = diag.policy == "isolate"
+    logger.info("beginning backtracking")
+    backtrackspan = results.profiler.span("backtracking")
+    try:
+        if incremental:
+            # only countries whose changes or current boundaries changed since last build are processed
+            if not cachedir:
+                raise Exception("Incremental builds require a cachedir")
+            resultcache = ResultCache(os.path.join(cachedir, "results"), __version__)
+            results.begin_backtracking_partitioned(processes if partitioned else 1, cache=resultcache, isolate=isolate)
+        elif partitioned or isolate:
+            # countries not linked by any changes are processed separately, and in parallel if partitioned
+            results.begin_backtracking_partitioned(processes if partitioned else 1, isolate=isolate)
+        else:
+            results.begin_backtracking()
+    finally:
+        # also when a failure stopped the build
+        diag.save_manifest()
+    backtrackspan.stop()
+    if diag.failures:
+        logger.warning(diag.summary())
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(results.beautifier.summary())
 
-    # Save final geojson table
-    # TODO: do via pg instead
-    import pygeoj
-    finaldata = pygeoj.GeojsonFile()
+    # Write final table, one province at a time
+    # format depends on the file extension, see output.py
+    outputspan = results.profiler.span("output")
+    writer = open_writer(outfile, precision=precision)
     for prov in results.provs:
         properties = {}
         properties["country"] = prov.country
         properties.update(dict([(k.lower(),v) for k,v in prov.ids.items()]))
         properties.update(dict([(k.lower(),v) for k,v in prov.other.items()]))
-        properties["start"] = str(prov.start)
-        properties["end"] = str(prov.end)
-        geometry = prov.geometry
-        finaldata.add_feature(properties=properties, geometry=geometry)
-    finaldata.save(outfile)
+        properties["start"] = prov.start
+        properties["end"] = prov.end
+        writer.write(properties, prov.shape)
+    writer.close()
+    outputspan.stop()
+
+    if profile:
+        logger.info(results.profiler.summary())
+        if isinstance(profile, basestring):
+            results.profiler.save(profile)
 
-    return finaldata
+    return results
@@ -0,0 +1,356 @@
+# -*- coding: utf8 -*-
+
+"""
+Writers for the final province data.
+Features are written one at a time, so the output is never held in memory as a whole.
+Use open_writer() to get the right writer based on the file extension.
+"""
+
+import os
+import json
+import struct
+import shutil
+import tempfile
+import datetime
+import shapely, shapely.geometry
+
+from . import binary
+
+
+def round_coords(coords, precision):
+    "Round a nested GeoJSON coordinate sequence to the given number of decimals"
+    if isinstance(coords[0], (float,int)):
+        return [round(c, precision) for c in coords]
+    else:
+        return [round_coords(sub, precision) for sub in coords]
+
+def geojson_geometry(geometry, precision=None):
+    "GeoJSON dict from a shapely or GeoJSON geometry, optionally with rounded coordinates"
+    if hasattr(geometry, "geom_type"):
+        geometry = shapely.geometry.mapping(geometry)
+    if precision is not None:
+        geometry = {"type": geometry["type"],
+                    "coordinates": round_coords(geometry["coordinates"], precision)}
+    return geometry
+
+_encoder = json.JSONEncoder(separators=(",",":"))
+
+def encode_feature(properties, geometry, precision=None):
+    # dates are written as text, and missing dates as "None"
+    properties = dict((k, str(v) if k in ("start","end") else v) for k,v in properties.items())
+    feat = {"type": "Feature",
+            "properties": properties,
+            "geometry": geojson_geometry(geometry, precision)}
+    return _encoder.encode(feat)
+
+class GeojsonWriter:
+    "Regular GeoJSON FeatureCollection"
+    def __init__(self, filename, precision=None):
+        self.filename = filename
+        self.precision = precision
+        self.count = 0
+        self.file = open(filename, "wb")
+        self.file.write('{"type":"FeatureCollection","features":[\n')
+
+    def write(self, properties, geometry):
+        if self.count:
+            self.file.write(",\n")
+        self.file.write(encode_feature(properties, geometry, self.precision))
+        self.count += 1
+
+    def close(self):
+        self.file.write("\n]}\n")
+        self.file.close()
+
+class NewlineGeojsonWriter:
+    "Newline-delimited GeoJSON, one feature per line"
+    def __init__(self, filename, precision=None):
+        self.filename = filename
+        self.precision = precision
+        self.count = 0
+        self.file = open(filename, "wb")
+
+    def write(self, properties, geometry):
+        self.file.write(encode_feature(properties, geometry, self.precision))
+        self.file.write("\n")
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+class FionaWriter:
+    """
+    GeoPackage, FlatGeobuf, or any other format supported by fiona (which must be installed).
+    All properties are written as text, with lists joined by "|" and dates as YYYY-MM-DD.
+    """
+    drivers = {".gpkg": "GPKG",
+               ".fgb": "FlatGeobuf",
+               ".shp": "ESRI Shapefile"}
+    
+    def __init__(self, filename, precision=None):
+        import fiona
+        self.fiona = fiona
+        self.filename = filename
+        self.precision = precision
+        self.count = 0
+        self.file = None
+
+    def _prep(self, properties):
+        return dict((k, "|".join(v) if isinstance(v, list) else v.isoformat() if hasattr(v, "isoformat") else v)
+                    for k,v in properties.items())
+
+    def write(self, properties, geometry):
+        properties = self._prep(properties)
+        if self.file is None:
+            # schema can only be known from the first feature
+            schema = {"geometry": "MultiPolygon",
+                      "properties": [(k, "str") for k in sorted(properties.keys())]}
+            driver = self.drivers[os.path.splitext(self.filename)[1].lower()]
+            self.file = self.fiona.open(self.filename, "w", driver=driver, schema=schema)
+        if hasattr(geometry, "geom_type") and geometry.geom_type == "Polygon":
+            geometry = shapely.geometry.MultiPolygon([geometry])
+        self.file.write({"properties": properties,
+                         "geometry": geojson_geometry(geometry, self.precision)})
+        self.count += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+class ArrowWriter:
+    """
+    Columnar GeoParquet (.parquet) or Arrow IPC/Feather (.arrow, .feather) file, using pyarrow 0.16,
+    the last version for python 2, or later (which must be installed).
+    Geometries are stored as WKB, country and type are dictionary encoded, start and end are dates,
+    alterns are lists, and any other properties are text.
+    Features are buffered and converted to columns one batch at a time. Parquet files get one
+    row group per batch, whereas Arrow IPC files keep the columns of the batches until closed,
+    since their dictionaries must be the same throughout the file.
+    The dictionaries only grow, so the codes of earlier batches stay valid.
+    """
+    batchsize = 10000
+    dictionary_columns = ("country", "type")
+    list_columns = ("alterns",)
+    date_columns = ("start", "end")
+
+    def __init__(self, filename, precision=None):
+        import pyarrow
+        if tuple(int(num) for num in pyarrow.__version__.split(".")[:2]) < (0, 16):
+            raise Exception("Writing %s requires pyarrow 0.16 or later, found %s" % (filename, pyarrow.__version__))
+        self.pa = pyarrow
+        self.filename = filename
+        self.precision = precision
+        self.parquet = os.path.splitext(filename)[1].lower() == ".parquet"
+        self.count = 0
+        self.schema = None
+        self.rows = []
+        self.batches = []
+        self.file = None
+        # dictionary column -> values in order of their codes, and the code of each value
+        self.dictionaries = dict((name, []) for name in self.dictionary_columns)
+        self._codes = dict((name, dict()) for name in self.dictionary_columns)
+
+    def _field(self, name):
+        pa = self.pa
+        if name in self.dictionary_columns:
+            return pa.field(name, pa.dictionary(pa.int32(), pa.string()))
+        elif name in self.list_columns:
+            return pa.field(name, pa.list_(pa.string()))
+        elif name in self.date_columns:
+            return pa.field(name, pa.date32())
+        else:
+            return pa.field(name, pa.string())
+
+    def _schema(self, properties):
+        # schema can only be known from the first feature
+        fields = [self._field(k) for k in sorted(properties.keys())]
+        fields.append(self.pa.field("geometry", self.pa.binary(),
+                                    metadata={"ARROW:extension:name": "geoarrow.wkb"}))
+        geo = {"version": "1.0.0",
+               "primary_column": "geometry",
+               "columns": {"geometry": {"encoding": "WKB", "geometry_types": []}}}
+        return self.pa.schema(fields, metadata={"geo": json.dumps(geo)})
+
+    def _value(self, name, val):
+        if val is None:
+            return None
+        elif name in self.date_columns:
+            return datetime.date(val.year, val.month, val.day)
+        elif name in self.list_columns:
+            return list(val) if isinstance(val, list) else val.split("|")
+        elif isinstance(val, list):
+            return "|".join(val)
+        elif not isinstance(val, basestring):
+            return str(val)
+        return val
+
+    def write(self, properties, geometry):
+        if self.schema is None:
+            self.schema = self._schema(properties)
+        if geometry is not None:
+            if not hasattr(geometry, "geom_type") or self.precision is not None:
+                geometry = shapely.geometry.shape(geojson_geometry(geometry, self.precision))
+            geometry = geometry.wkb
+        self.rows.append((properties, geometry))
+        self.count += 1
+        if len(self.rows) >= self.batchsize:
+            self._flush()
+
+    def _code(self, name, val):
+        if val is None:
+            return None
+        codes = self._codes[name]
+        if val not in codes:
+            codes[val] = len(codes)
+            self.dictionaries[name].append(val)
+        return codes[val]
+
+    def _flush(self):
+        pa = self.pa
+        columns = []
+        for field in self.schema:
+            if field.name == "geometry":
+                columns.append(pa.array([wkb for properties,wkb in self.rows], pa.binary()))
+            elif field.name in self.dictionary_columns:
+                codes = [self._code(field.name, self._value(field.name, properties.get(field.name))) for properties,wkb in self.rows]
+                columns.append(pa.array(codes, pa.int32()))
+            else:
+                values = [self._value(field.name, properties.get(field.name)) for properties,wkb in self.rows]
+                columns.append(pa.array(values, field.type))
+        self.rows = []
+        if self.parquet:
+            # each batch becomes a row group
+            if self.file is None:
+                import pyarrow.parquet
+                self.file = pyarrow.parquet.ParquetWriter(self.filename, self.schema)
+            self.file.write_table(pa.Table.from_batches([self._batch(columns)], schema=self.schema))
+        else:
+            # ipc files need the same dictionaries in all batches, so these are made when closing
+            self.batches.append(columns)
+
+    def _batch(self, columns, dictionaries=None):
+        pa = self.pa
+        if dictionaries is None:
+            dictionaries = dict((name, pa.array(values, pa.string())) for name,values in self.dictionaries.items())
+        arrays = [pa.DictionaryArray.from_arrays(column, dictionaries[field.name]) if field.name in self.dictionary_columns else column
+                  for field,column in zip(self.schema, columns)]
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def close(self):
+        if self.rows:
+            self._flush()
+        if self.parquet:
+            if self.file is not None:
+                self.file.close()
+        elif self.batches:
+            pa = self.pa
+            dictionaries = dict((name, pa.array(values, pa.string())) for name,values in self.dictionaries.items())
+            sink = pa.OSFile(self.filename, "wb")
+            writer = pa.RecordBatchFileWriter(sink, self.schema)
+            for columns in self.batches:
+                writer.write_batch(self._batch(columns, dictionaries))
+            writer.close()
+            sink.close()
+
+class BinaryWriter:
+    """
+    Memory mappable .pshp file, see binary.py for the format and reader.
+    Columns and strings are kept in memory until closed, while the WKB goes to a temporary file.
+    """
+    date_columns = ("start", "end")
+    list_columns = ("alterns",)
+
+    def __init__(self, filename, precision=None):
+        self.filename = filename
+        self.precision = precision
+        self.count = 0
+        self.columns = None
+        self.values = None
+        self.strings = []
+        self._stringnums = dict()
+        self.geomoffsets = [0]
+        self.geomfile = tempfile.TemporaryFile()
+
+    def _string(self, val):
+        if val is None:
+            return binary.NULL
+        if isinstance(val, unicode):
+            val = val.encode("utf8")
+        if val not in self._stringnums:
+            self._stringnums[val] = len(self.strings)
+            self.strings.append(val)
+        return self._stringnums[val]
+
+    def _value(self, name, typ, val):
+        if typ == binary.DATE:
+            if val is None:
+                return 0
+            return datetime.date(val.year, val.month, val.day).toordinal()
+        elif isinstance(val, list):
+            val = binary.LIST_SEPARATOR.join(val)
+        elif val is not None and not isinstance(val, basestring):
+            val = str(val)
+        return self._string(val)
+
+    def write(self, properties, geometry):
+        if self.columns is None:
+            # columns can only be known from the first feature
+            names = sorted(properties.keys())
+            types = [binary.DATE if name in self.date_columns else binary.LIST if name in self.list_columns else binary.TEXT
+                     for name in names]
+            self.columns = zip(names, types)
+            self.values = [[] for _ in names]
+        for (name,typ),values in zip(self.columns, self.values):
+            values.append(self._value(name, typ, properties.get(name)))
+        if geometry is not None:
+            if not hasattr(geometry, "geom_type") or self.precision is not None:
+                geometry = shapely.geometry.shape(geojson_geometry(geometry, self.precision))
+            self.geomfile.write(geometry.wkb)
+        self.geomoffsets.append(self.geomfile.tell())
+        self.count += 1
+
+    def close(self):
+        columns = self.columns or []
+        names = [self._string(name) for name,typ in columns]
+        with open(self.filename, "wb") as writer:
+            # sections are written in order, so their offsets are known beforehand
+            data = binary.HEADER.size + binary.COLUMN.size * len(columns)
+            strings = data + 4 * len(columns) * self.count
+            geomoffsets = strings + 4 + 8 * (len(self.strings) + 1) + sum(len(string) for string in self.strings)
+            geoms = geomoffsets + 8 * len(self.geomoffsets)
+            writer.write(binary.HEADER.pack(binary.MAGIC, binary.VERSION, len(columns), self.count,
+                                            data, strings, geomoffsets, geoms))
+            for name,(_,typ) in zip(names, columns):
+                writer.write(binary.COLUMN.pack(name, typ))
+            for (_,typ),values in zip(columns, self.values or []):
+                writer.write(struct.pack("<%d%s" % (len(values), "i" if typ == binary.DATE else "I"), *values))
+            offsets = [0]
+            for string in self.strings:
+                offsets.append(offsets[-1] + len(string))
+            writer.write(struct.pack("<I%dQ" % len(offsets), len(self.strings), *offsets))
+            for string in self.strings:
+                writer.write(string)
+            writer.write(struct.pack("<%dQ" % len(self.geomoffsets), *self.geomoffsets))
+            self.geomfile.seek(0)
+            shutil.copyfileobj(self.geomfile, writer)
+        self.geomfile.close()
+
+writers = {".geojson": GeojsonWriter,
+           ".json": GeojsonWriter,
+           ".geojsonl": NewlineGeojsonWriter,
+           ".geojsons": NewlineGeojsonWriter,
+           ".ndjson": NewlineGeojsonWriter,
+           ".gpkg": FionaWriter,
+           ".fgb": FionaWriter,
+           ".shp": FionaWriter,
+           ".parquet": ArrowWriter,
+           ".arrow": ArrowWriter,
+           ".feather": ArrowWriter,
+           ".pshp": BinaryWriter}
+
+def open_writer(filename, precision=None):
+    "Writer for the given output file, based on its extension"
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in writers:
+        raise Exception("Unknown output file format %s, must be one of %s" % (ext, ", ".join(sorted(writers))))
+    return writers[ext](filename, precision=precision)
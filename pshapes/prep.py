@@ -1,23 +1,27 @@
 # -*- coding: cp1252 -*-
 
+import csv
 import itertools
 import datetime
 import warnings
 import urllib
+import logging
 import dateutil, dateutil.parser
 import pygeoj
 import shapely, shapely.ops, shapely.geometry
 from unidecode import unidecode
 
 from .process import *
-import pythongis as pg
 
+logger = logging.getLogger(__name__)
 
 ##############################
 
 class CurrentBoundaries():
 
     def __init__(self, filename, countryfield, subnamefield, subalternsfield, subisofield, subfipsfield='', subhascfield='', subtypefield='', subcapitalfield=''): 
+        # only needed for reading the current boundaries
+        import pythongis as pg
         self.data = pg.VectorData(filename, encoding="utf8", encoding_errors="replace",
                                   )
         self.data = self.data.select(lambda f: f.geometry) #f.get_shapely().is_valid)
@@ -29,7 +33,7 @@ class CurrentBoundaries():
         self.subhascfield = subhascfield
         self.subtypefield = subtypefield
         self.subcapitalfield = subcapitalfield
-        print 'current data loaded'
+        logger.info("current data loaded")
 
     def prepare(self, func):
         for feat in self.data:
@@ -56,6 +60,70 @@ class CurrentBoundaries():
             f = self.data.add_feature(f.row, f.geometry)
     
 
+class ChangeRow(object):
+    """
+    One row of the change data, with typed values:
+    date as datetime.date, type as the name of its change type (see process.change_types), empty or "X" values as None,
+    names stripped, and alterns as a list.
+    Indexing by field name gives text like a csv row, eg for ignore_events functions: the date as YYYY-MM-DD,
+    alterns joined by "|" or None, and the other values as above, ie stripped and with None for empty or "X".
+    """
+    fields = ("source", "status", "date", "type",
+              "fromcountry", "fromname", "fromalterns", "fromiso", "fromfips", "fromhasc", "fromtype", "fromcapitalname", "fromcapital",
+              "tocountry", "toname", "toalterns", "toiso", "tofips", "tohasc", "totype", "tocapitalname", "tocapital",
+              "transfer_source", "transfer_reference", "transfer_geom")
+    __slots__ = fields
+
+    def __getitem__(self, field):
+        val = getattr(self, field)
+        if field == "date":
+            return val.isoformat()
+        elif field.endswith("alterns"):
+            return "|".join(val) if val else None
+        return val
+
+    def __repr__(self):
+        text = u"ChangeRow: %s %s %s --> %s" % (self.date, self.type, self.fromcountry, self.tocountry)
+        return text.encode("utf8")
+
+def parse_change_rows(filename, skip=None):
+    "Stream ChangeRows from the change data csv in one pass, leaving out NonActive changes and those involving skip countries"
+    skip = set(skip or [])
+    dates = dict()
+    with open(filename, "rb") as reader:
+        rows = csv.reader(reader)
+        header = [field.strip().lower() for field in next(rows)]
+        positions = [(field, header.index(field) if field in header else None) for field in ChangeRow.fields]
+        for cells in rows:
+            if not any(cells):
+                continue
+            row = ChangeRow()
+            for field,i in positions:
+                val = cells[i].decode("utf8") if i is not None and i < len(cells) else None
+                # remove junk
+                if not val or val == "X":
+                    val = None
+                setattr(row, field, val)
+            if row.status == "NonActive" or row.fromcountry in skip or row.tocountry in skip:
+                continue
+            # the same dates come up over and over, so only parse each once
+            if row.date not in dates:
+                dates[row.date] = parse_date(row.date) if row.date else None
+            row.date = dates[row.date]
+            for side in ("from","to"):
+                name = getattr(row, side+"name")
+                setattr(row, side+"name", name.strip() if name else name)
+                alterns = getattr(row, side+"alterns")
+                setattr(row, side+"alterns", [alt.strip() for alt in alterns.split("|")] if alterns else [])
+            yield row
+
+def parse_date(val):
+    try:
+        date = datetime.datetime.strptime(val, "%Y-%m-%d")
+    except ValueError:
+        date = dateutil.parser.parse(val)
+    return datetime.date(year=date.year, month=date.month, day=date.day)
+
 class ChangeData():
 
     def __init__(self, filename=None, skip=None):
@@ -63,19 +131,29 @@ class ChangeData():
         if not filename:
             filename = "pshapes_raw_auto.csv"
             with open(filename, "wb") as writer:
-                print "downloading latest..."
+                logger.info("downloading latest...")
                 raw = urllib.urlopen("http://pshapes.org/download/raw/").read()
                 writer.write(raw)
 
         # load event data
-        skip = skip or []
-        self.data = pg.VectorData(filename, encoding="utf8", sniffsize=20,
-                                    select=lambda f: f["status"] != "NonActive" and (f["fromcountry"] not in skip and f["tocountry"] not in skip) )
+        self.rows = list(parse_change_rows(filename, skip))
         
     def ignore_events(self, ignorefunc):
-        def wrap(f):
-            return not ignorefunc(f)
-        self.data = self.data.select(wrap)
+        self.rows = [row for row in self.rows if not ignorefunc(row)]
+
+    def events(self):
+        "Yields (date, rows) for each date with changes, in order of date and otherwise as in the file"
+        key = lambda row: row.date
+        for date,rows in itertools.groupby(sorted(self.rows, key=key), key=key):
+            yield date, list(rows)
+
+    def countries(self):
+        "All from and to countries in the change data"
+        countries = set()
+        for row in self.rows:
+            countries.add(row.fromcountry)
+            countries.add(row.tocountry)
+        return countries
         
 
 
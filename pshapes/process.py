@@ -49,11 +49,26 @@ Works, but not yet documented or user-friendly for end-users.
 import itertools
 import datetime
 import warnings
+import multiprocessing
+import logging
+import traceback
+import json
+import ast
 import dateutil, dateutil.parser
 import pygeoj
-import shapely, shapely.ops, shapely.geometry
+import shapely, shapely.ops, shapely.geometry, shapely.wkb, shapely.prepared
 from unidecode import unidecode
 
+from .beautify import get_beautifier
+from .geomops import union_parts, vertex_count
+from .profiling import Profiler, NullProfiler
+from .diagnostics import Diagnostics
+
+logger = logging.getLogger(__name__)
+
+# default end date of provinces that still exist, ie the date of the current boundaries
+MAXDATE = datetime.date(year=2015, month=1, day=1)
+
 
 
 
@@ -70,6 +85,21 @@ def validate_changetable():
 
 # Read the table and insert into event-changes object model hierarchy
 
+def parse_cutpoly(cutpoly):
+    "Read a transfer_geom value from the change table, either GeoJSON text, hex WKB, or an already parsed geometry"
+    if hasattr(cutpoly, "geom_type"):
+        return cutpoly
+    raw = cutpoly.strip()
+    if raw.startswith("{"):
+        try:
+            geoj = json.loads(raw)
+        except ValueError:
+            # older python-style dict reprs, with single quotes or tuples
+            geoj = ast.literal_eval(raw)
+        return shapely.geometry.shape(geoj)
+    else:
+        return shapely.wkb.loads(raw, hex=True)
+
 class Event:
     def __init__(self):
         self.date = None
@@ -80,7 +110,7 @@ class MergeNewChange:
         self.type = "MergeNew"
         self.fromprov = fromprov
         self.toprov = toprov
-        self.cutpoly = shapely.geometry.shape(eval(cutpoly))
+        self.cutpoly = parse_cutpoly(cutpoly)
 
     def __repr__(self):
         return "MergeNew {fromm} --> {to}".format(fromm=self.fromprov, to=self.toprov)
@@ -90,7 +120,7 @@ class MergeExistingChange:
         self.type = "MergeExisting"
         self.fromprov = fromprov
         self.toprov = toprov
-        self.cutpoly = shapely.geometry.shape(eval(cutpoly))
+        self.cutpoly = parse_cutpoly(cutpoly)
 
     def __repr__(self):
         return "MergeExisting {fromm} --> {to}".format(fromm=self.fromprov, to=self.toprov)
@@ -100,7 +130,7 @@ class TransferNewChange:
         self.type = "TransferNew"
         self.fromprov = fromprov
         self.toprov = toprov
-        self.cutpoly = shapely.geometry.shape(eval(cutpoly))
+        self.cutpoly = parse_cutpoly(cutpoly)
 
     def __repr__(self):
         return "TransferNew {fromm} --> {to}".format(fromm=self.fromprov, to=self.toprov)
@@ -110,7 +140,7 @@ class TransferExistingChange:
         self.type = "TransferExisting"
         self.fromprov = fromprov
         self.toprov = toprov
-        self.cutpoly = shapely.geometry.shape(eval(cutpoly))
+        self.cutpoly = parse_cutpoly(cutpoly)
 
     def __repr__(self):
         return "TransferExisting {fromm} --> {to}".format(fromm=self.fromprov, to=self.toprov)
@@ -151,6 +181,27 @@ class BeginChange:
     def __repr__(self):
         return "Begin {to} -->".format(to=self.toprov)
 
+# change type name in the change data -> (change class, whether it needs a cutpoly)
+change_types = dict()
+
+def register_change_type(name, changeclass, cutpoly=False, aliases=()):
+    """
+    Makes build() create changeclass(fromprov, toprov) for rows of the given type or any of its aliases,
+    or changeclass(fromprov, toprov, cutpoly) if cutpoly is True, in which case rows without a transfer_geom are skipped.
+    Backtracking goes by the type attribute of the change, so new classes should subclass or behave like one of the existing ones.
+    """
+    for typename in [name] + list(aliases):
+        change_types[typename] = (changeclass, cutpoly)
+
+register_change_type("MergeNew", MergeNewChange, cutpoly=True)
+register_change_type("MergeExisting", MergeExistingChange, cutpoly=True, aliases=["FullTransfer"])
+register_change_type("TransferNew", TransferNewChange, cutpoly=True)
+register_change_type("TransferExisting", TransferExistingChange, cutpoly=True, aliases=["PartTransfer"])
+register_change_type("Breakaway", BreakawayChange)
+register_change_type("SplitPart", SplitPartChange)
+register_change_type("NewInfo", NewInfoChange)
+register_change_type("Begin", BeginChange)
+
 class Remainder:
     def __init__(self, fromprov, geom):
         self.type = "Remainder"
@@ -180,14 +231,8 @@ def ids_equal(find, comparison):
     if find.country == comparison.country:
         #match = any((validid(otherid) and otherid in find.ids.values()
         #             for otherid in comparison.ids.values() ))
-        names = [find.ids["Name"]] + find.ids["Alterns"]
-        names += [unidecode(n) for n in names if n != unidecode(n)]
-        for name in names:
-            compnames = [comparison.ids["Name"]] + comparison.ids["Alterns"]
-            compnames += [unidecode(n) for n in compnames if n != unidecode(n)]
-            match = name in compnames
-            if match:
-                break
+        # any shared name, alternate name, or their unidecoded versions
+        match = not find.namekeys.isdisjoint(comparison.namekeys)
         if not match:
             match = find.ids["HASC"] and len(find.ids["HASC"]) > 3 and comparison.ids["HASC"] == find.ids["HASC"]
             if match: return match
@@ -200,15 +245,118 @@ def ids_equal(find, comparison):
         pass
     return match
 
-class Province:
+def name_keys(ids):
+    "Normalized set of all names and alternate names, including their unidecoded versions"
+    names = [ids["Name"]] + ids["Alterns"]
+    names += [unidecode(n) for n in names if n != unidecode(n)]
+    return frozenset(names)
+
+def index_keys(prov):
+    "All keys under which a prov can be matched by ids_equal, ie when it is the comparison"
+    keys = [("Name",name) for name in prov.namekeys]
+    for field in ("HASC","ISO","FIPS"):
+        if prov.ids[field]:
+            keys.append((field,prov.ids[field]))
+    return keys
+
+def lookup_keys(prov):
+    "The keys that ids_equal would try when looking for a prov, ie when it is the find"
+    keys = [("Name",name) for name in prov.namekeys]
+    if prov.ids["HASC"] and len(prov.ids["HASC"]) > 3:
+        keys.append(("HASC",prov.ids["HASC"]))
+    for field in ("ISO","FIPS"):
+        if prov.ids[field]:
+            keys.append((field,prov.ids[field]))
+    return keys
+
+_interned = dict()
+
+def intern_string(val):
+    "Like the builtin intern, but also works for unicode, and passes through non-strings"
+    if isinstance(val, basestring):
+        return _interned.setdefault((type(val),val), val)
+    return val
+
+def intern_values(dct):
+    "Intern all string values of an ids or other dict in place, including lists of strings"
+    for key,val in dct.items():
+        if isinstance(val, list):
+            dct[key] = [intern_string(v) for v in val]
+        else:
+            dct[key] = intern_string(val)
+    return dct
+
+class Province(object):
+    # kept lean since a global build holds tens of thousands of these
+    # geometry is stored as WKB and only converted when accessed
+    __slots__ = ("country", "start", "end", "_ids", "_other", "_wkb", "_namekeys")
+    
     def __init__(self, country, start, end, ids, other, geometry):
-        self.country = country
+        self.country = intern_string(country)
         self.start = start
         self.end = end
         self.ids = ids
         self.other = other
         self.geometry = geometry
 
+    def __getstate__(self):
+        return (self.country, self.start, self.end, self._ids, self._other, self._wkb)
+
+    def __setstate__(self, state):
+        country, self.start, self.end, ids, other, self._wkb = state
+        self.country = intern_string(country)
+        self.ids = ids
+        self.other = other
+
+    @property
+    def geometry(self):
+        "GeoJSON dict of the geometry, or None"
+        if self._wkb is not None:
+            return shapely.wkb.loads(self._wkb).__geo_interface__
+
+    @geometry.setter
+    def geometry(self, geometry):
+        if geometry is None:
+            self._wkb = None
+        else:
+            if not hasattr(geometry, "wkb"):
+                geometry = shapely.geometry.shape(geometry)
+            self._wkb = geometry.wkb
+
+    @property
+    def shape(self):
+        "Shapely geometry, or None"
+        if self._wkb is not None:
+            return shapely.wkb.loads(self._wkb)
+
+    @shape.setter
+    def shape(self, geometry):
+        self.geometry = geometry
+
+    @property
+    def ids(self):
+        return self._ids
+
+    @ids.setter
+    def ids(self, ids):
+        self._ids = intern_values(ids)
+        self._namekeys = None
+
+    @property
+    def other(self):
+        return self._other
+
+    @other.setter
+    def other(self, other):
+        self._other = intern_values(other)
+
+    @property
+    def namekeys(self):
+        "Computed once from ids and reset when ids is set, so ids should be replaced rather than modified in place"
+        if self._namekeys is None:
+            self._namekeys = name_keys(self._ids)
+        return self._namekeys
+
     def __repr__(self):
         name = self.ids["Name"].encode("utf8")
         country = self.country.encode("utf8")
@@ -217,20 +365,161 @@ class Province:
         else:
             return "Province: {name}, {country}".format(name=name, country=country)
 
+def country_components(events, provs=()):
+    """Group countries into connected components that can be backtracked independently.
+    Countries are only linked by changes where fromcountry and tocountry differ.
+    Returns a sorted list of sorted country lists."""
+    parent = dict()
+    def root(country):
+        parent.setdefault(country, country)
+        while parent[country] != country:
+            parent[country] = parent[parent[country]]
+            country = parent[country]
+        return country
+    for prov in provs:
+        root(prov.country)
+    for event in events:
+        for change in event.changes:
+            a,b = root(change.fromprov.country),root(change.toprov.country)
+            if a != b:
+                parent[max(a,b)] = min(a,b)
+    components = dict()
+    for country in parent:
+        components.setdefault(root(country), []).append(country)
+    return sorted(sorted(countries) for countries in components.values())
+
+def group_similar(subparts):
+    """Group subparts by country, and then by the ids of their fromprov.
+    Each group starts with the first remaining subpart, followed by all later ones
+    whose fromprov it matches with ids_equal, in reverse order. Matching is not transitive,
+    so a subpart only matching another member of the group starts a group of its own.
+    Yields (fromprovcountry, group) pairs."""
+    key = lambda ch: ch.fromprov.country
+    for fromprovcountry,countryparts in itertools.groupby(sorted(subparts, key=key), key=key):
+        countryparts = list(countryparts)
+        # key -> positions of the subparts whose fromprov can be matched by that key
+        index = dict()
+        for i,part in enumerate(countryparts):
+            for k in index_keys(part.fromprov):
+                index.setdefault(k, set()).add(i)
+        grouped = set()
+        for i,frst in enumerate(countryparts):
+            if i in grouped:
+                continue
+            grouped.add(i)
+            candidates = set()
+            for k in lookup_keys(frst.fromprov):
+                candidates.update(index.get(k, ()))
+            matches = sorted((j for j in candidates
+                              if j > i and j not in grouped and ids_equal(frst.fromprov, countryparts[j].fromprov)),
+                             reverse=True)
+            grouped.update(matches)
+            yield fromprovcountry, [frst] + [countryparts[j] for j in matches]
+
+def bounds_overlap(a, b):
+    "Whether two (xmin, ymin, xmax, ymax) bounding boxes intersect"
+    # empty geometries have no bounds
+    return bool(a) and bool(b) and a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def _backtrack(table):
+    with table.profiler.span("component", ",".join(sorted(table._bycountry))):
+        table.begin_backtracking()
+    return table.provs, table.beautifier.timings, table.profiler, table.diagnostics.failures
+
+def _backtrack_isolated(table):
+    # same as _backtrack, but a failure only loses this component, with provs as None
+    try:
+        return _backtrack(table)
+    except Exception as err:
+        countries = sorted(table._bycountry)
+        table.diagnostics.record("component", "Backtracking of %s failed: %s" % (", ".join(countries), err),
+                                 countries=countries, error=repr(err), traceback=traceback.format_exc())
+        logger.warning("backtracking of %s failed, leaving them out: %s", ", ".join(countries), err)
+        return None, table.beautifier.timings, table.profiler, table.diagnostics.failures
+
 class ResultsTable:
-    def __init__(self, matchfunc=ids_equal, maxdate=datetime.date(year=2015, month=1, day=1)):
+    def __init__(self, matchfunc=ids_equal, maxdate=MAXDATE, beautify="buffer", union="auto", profiler=None, diagnostics=None, checkpoints=None):
         self.provs = []
         self.events = []
         self.matchfunc = matchfunc
         self.maxdate = maxdate
+        self.beautifier = get_beautifier(beautify)
+        self.union = union
+        # see profiling.py
+        self.profiler = profiler or NullProfiler()
+        # what to do about failures, see diagnostics.py
+        self.diagnostics = diagnostics or Diagnostics()
+        # periodic snapshots while backtracking, see cache.Checkpoints
+        self.checkpoints = checkpoints
+        # lookup index, country -> key -> positions in self.provs
+        self._index = dict()
+        self._bycountry = dict()
+        # country -> [position, bounds] of provs not yet given a startdate, bounds are filled in by query
+        self._live = dict()
+
+    def _register(self, prov):
+        i = len(self.provs)
+        self.provs.append(prov)
+        self._bycountry.setdefault(prov.country, []).append(i)
+        if prov.start is None:
+            self._live.setdefault(prov.country, []).append([i, None])
+        countryindex = self._index.setdefault(prov.country, dict())
+        for key in index_keys(prov):
+            countryindex.setdefault(key, []).append(i)
+
+    def reindex(self):
+        "Rebuild the lookup index, needed if self.provs has been modified directly"
+        provs = self.provs
+        self.provs = []
+        self._index = dict()
+        self._bycountry = dict()
+        self._live = dict()
+        for prov in provs:
+            self._register(prov)
+
+    def candidates(self, findprov):
+        "Positions of all provs that can possibly be matched by ids_equal, in the order they were added"
+        countryindex = self._index.get(findprov.country)
+        if not countryindex:
+            return []
+        positions = set()
+        for key in lookup_keys(findprov):
+            positions.update(countryindex.get(key, []))
+        return sorted(positions)
+
+    def query(self, geom, country):
+        "All provs of a country not yet given a startdate whose bounding box intersects geom"
+        bounds = geom.bounds
+        # drop the provs that got a startdate since the last query
+        entries = [entry for entry in self._live.get(country, []) if self.provs[entry[0]].start is None]
+        self._live[country] = entries
+        provs = []
+        for entry in entries:
+            if entry[1] is None:
+                entry[1] = self.provs[entry[0]].shape.bounds
+            if bounds_overlap(bounds, entry[1]):
+                provs.append(self.provs[entry[0]])
+        return provs
+
+    def cut(self, geom, cutpoly, prepared=None):
+        "Splits geom into the part inside cutpoly and the rest, prepared is the cutpoly prepared by shapely.prepared.prep"
+        if prepared is None:
+            prepared = shapely.prepared.prep(cutpoly)
+        if not bounds_overlap(cutpoly.bounds, geom.bounds) or not prepared.intersects(geom):
+            # no overlap, no need for the expensive overlay
+            return shapely.geometry.GeometryCollection(), geom
+        return geom.intersection(cutpoly), geom.difference(cutpoly)
 
     def add_province(self, country, start, end, ids, other, geometry):                
+        "The geometry can be GeoJSON or shapely, and is stored as shapely/WKB from here on"
         if not geometry:
             raise Exception("ResultsTable province must have geometry")
-        shp = shapely.geometry.shape(geometry)
+        if not hasattr(geometry, "geom_type"):
+            geometry = shapely.geometry.shape(geometry)
+        shp = geometry
         if not shp.is_valid:
             try:
-                geometry = shp.buffer(0).__geo_interface__
+                geometry = shp.buffer(0)
             except: 
                 raise Exception("Invalid geometry: must be valid, and Polygon or MultiPolygon")
         elif "Polygon" not in shp.geom_type:
@@ -241,15 +530,26 @@ class ResultsTable:
         if end is None: end = self.maxdate
         
         prov = Province(country, start, end, ids, other, geometry)
-        self.provs.append(prov)
+        self._register(prov)
    
     def find_prov(self, findprov, fuzzythresh=0.8):
         "Lookup id and return matching feature GeoJSON among existing registered provs"
         matchfunc = self.matchfunc
-        newprovs = sorted((prov for prov in self.provs if matchfunc(findprov, prov)), key=lambda f: f.end)
+        if matchfunc is ids_equal:
+            # only need to check those provs sharing at least one key
+            positions = self.candidates(findprov)
+            provs = (self.provs[i] for i in positions)
+            self.profiler.count("matchfunc calls", len(positions))
+        else:
+            # custom matchfunc, cant make assumptions about the keys
+            provs = self.provs
+            self.profiler.count("matchfunc calls", len(provs))
+        newprovs = sorted((prov for prov in provs if matchfunc(findprov, prov)), key=lambda f: f.end)
         if not newprovs:
+            self.profiler.count("fuzzy fallbacks")
             import difflib
-            matches = sorted([(p,difflib.SequenceMatcher(None,findprov.ids["Name"],p.ids["Name"]).ratio()) for p in self.provs if p.country == findprov.country], key=lambda pair: pair[1])
+            countryprovs = [self.provs[i] for i in self._bycountry.get(findprov.country, [])]
+            matches = sorted([(p,difflib.SequenceMatcher(None,findprov.ids["Name"],p.ids["Name"]).ratio()) for p in countryprovs], key=lambda pair: pair[1])
             matches = ((p,r) for p,r in matches if r >= fuzzythresh)
             matches = sorted(matches, key=lambda(p,r): (p.end,-r))
             newprovs = [p for p,r in matches]
@@ -265,6 +565,80 @@ class ResultsTable:
     def add_event(self, event):
         self.events.append(event)
 
+    def partition(self):
+        "Split into one independent ResultsTable for each connected component of countries"
+        components = country_components(self.events, self.provs)
+        lookup = dict((country,i) for i,countries in enumerate(components) for country in countries)
+        tables = [ResultsTable(self.matchfunc, self.maxdate, self.beautifier.copy(), self.union,
+                               profiler=Profiler() if self.profiler.enabled else None,
+                               diagnostics=self.diagnostics.copy(),
+                               checkpoints=self.checkpoints)
+                  for _ in components]
+        for prov in self.provs:
+            tables[lookup[prov.country]]._register(prov)
+        for event in self.events:
+            subevents = dict()
+            for change in event.changes:
+                i = lookup[change.fromprov.country]
+                if i not in subevents:
+                    subevents[i] = Event()
+                    subevents[i].date = event.date
+                subevents[i].changes.append(change)
+            for i,subevent in subevents.items():
+                tables[i].add_event(subevent)
+        return tables
+
+    def begin_backtracking_partitioned(self, processes=None, cache=None, isolate=False):
+        """
+        Same as begin_backtracking, but each connected component of countries is backtracked
+        separately in a pool of processes (defaults to the number of cpus, or 1 for no pool).
+        The resulting provs are ordered by component, and otherwise as with begin_backtracking.
+
+        If a ResultCache is given, components whose inputs are unchanged since a previous run
+        are taken from the cache, and only the rest are backtracked. 
+
+        If isolate is True, a component that fails is recorded in the diagnostics
+        and left out of the results, instead of stopping the whole run.
+        """
+        tables = self.partition()
+        results = [None] * len(tables)
+        if cache:
+            keys = [cache.key(table) for table in tables]
+            for i,key in enumerate(keys):
+                provs = cache.get(key)
+                if provs is not None:
+                    results[i] = provs, [], None, []
+            logger.info("reusing %s of %s cached country groups", len([r for r in results if r]), len(tables))
+        todo = [i for i,result in enumerate(results) if result is None]
+        backtrack = _backtrack_isolated if isolate else _backtrack
+        if processes == 1:
+            for i in todo:
+                results[i] = backtrack(tables[i])
+        else:
+            # submit largest components first, so the long ones dont end up last
+            todo = sorted(todo, key=lambda i: -len(tables[i].provs) * (len(tables[i].events) + 1))
+            pool = multiprocessing.Pool(processes)
+            try:
+                done = pool.map(backtrack, [tables[i] for i in todo], chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+            for i,result in zip(todo, done):
+                results[i] = result
+        if cache:
+            for i in todo:
+                provs,timings,profiler,failures = results[i]
+                # components with failures are redone next time, so they are reported again
+                if provs is not None and not failures:
+                    cache.put(keys[i], provs)
+        self.provs = [prov for provs,timings,profiler,failures in results if provs is not None for prov in provs]
+        self.reindex()
+        for provs,timings,profiler,failures in results:
+            self.beautifier.timings.extend(timings)
+            if profiler:
+                self.profiler.merge(profiler)
+            self.diagnostics.merge(failures)
+
     def begin_backtracking(self):
         """
         Process input and create output.
@@ -272,24 +646,48 @@ class ResultsTable:
         NOTE: new entry is created if: 1) just new info [but not guaranteed to include all such changes], 2) new info and new geometry, 3) just new geometry
         """
                 
+        # some debug messages need geometry calculations, so only do them when needed
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        events = sorted(self.events, key=lambda ev: ev.date, reverse=True)
+        done = 0
+        if self.checkpoints:
+            # continue after the last checkpoint of the same inputs, if resuming
+            checkpointkey = self.checkpoints.key(self)
+            state = self.checkpoints.load(checkpointkey)
+            if state:
+                done,self.provs,pending,failures = state
+                self.reindex()
+                if pending is not None:
+                    self.beautifier.pending = pending
+                self.diagnostics.merge(failures)
+                logger.info("resuming from checkpoint after %s of %s events", done, len(events))
+
         # For each event
-        for event in sorted(self.events, key=lambda ev: ev.date, reverse=True):
-            print "----------"
-            print event.date
+        for event in events[done:]:
+            eventspan = self.profiler.span("event", event.date)
+            logger.debug("----------")
+            logger.debug("%s", event.date)
+
+            # time spent on each country, each group of changes stops the span of the previous one since they have many exits
+            countryspan = None
 
             # 1) Group all entries by toprov
-            print "by toprov"
+            logger.debug("by toprov")
             allsubparts = []
             key = lambda ch: (ch.toprov.ids["Name"],ch.toprov.country)
             for (toprovname,toprovcountry),changes in itertools.groupby(sorted(event.changes, key=key), key=key):
+                if countryspan: countryspan.stop()
+                countryspan = self.profiler.span("country", toprovcountry)
                 changes = list(changes)
                 toprov = changes[0].toprov
                 if toprov.ids["Name"] == "*":
                     continue
-                print changes
+                logger.debug("%s", changes)
 
                 # Lookup the toprov geometry
-                newprov = self.find_prov(toprov)
+                with self.profiler.span("find_prov"):
+                    newprov = self.find_prov(toprov)
 ##                if not newprov:
 ##                    # maybe special case where split prov also receives a transfer
 ##                    # in which case transfers are coded with the old pre-split prov as the toprov, then split
@@ -311,21 +709,23 @@ class ResultsTable:
                 
                 if not newprov:
                     # couldnt find provcode, need better lookup, maybe using multiple ids
-                    print toprov.ids
+                    logger.debug("%s", toprov.ids)
                     avail = "\n".join((repr(p) for p in self.provs if p.country == toprovcountry))
-                    raise Exception("Couldnt find province %s \nAvailable options: \n %s" % (toprov,avail) )
+                    self.diagnostics.failure("notfound", "Couldnt find province %s \nAvailable options: \n %s" % (toprov,avail),
+                                             [("cutpoly %s" % i, change.cutpoly) for i,change in enumerate(changes) if getattr(change, "cutpoly", None)],
+                                             date=event.date, country=toprovcountry, toprov=toprov.ids, changes=[repr(change) for change in changes])
+                    continue
                 
-                if not newprov.geometry or newprov.geometry["type"] == "GeometryCollection":
+                newprovgeom = newprov.shape
+                if newprovgeom is None or newprovgeom.geom_type == "GeometryCollection":
                     # lookup prov has invalid geom
-                    raise Exception("Lookup province %s has invalid geometry" % newprov)
-
-                newprovgeom = shapely.geometry.shape(newprov.geometry)
-
-                print "NEWGEOM", toprov, " = ", newprov, newprovgeom.area
+                    self.diagnostics.failure("invalidlookup", "Lookup province %s has invalid geometry" % newprov,
+                                             [("orig geom", newprovgeom)],
+                                             date=event.date, country=toprovcountry, toprov=toprov.ids, changes=[repr(change) for change in changes])
+                    continue
 
-                # Also change the startdate of the newer prov
-                newprov.start = event.date
-                print "changed date", newprov, newprov.start, newprov.end
+                if debug:
+                    logger.debug("NEWGEOM %s = %s %s", toprov, newprov, newprovgeom.area)
 
                 # testing                
 ##                if newprov.ids["Name"] == "Adamaoua":
@@ -333,21 +733,31 @@ class ResultsTable:
 ##                    dat = pg.VectorData(type="Polygon")
 ##                    pg.vector.data.Feature(dat, [], newprovgeom.__geo_interface__).view(500,500)
 
+                if self.profiler.enabled:
+                    self.profiler.count("cut vertices", vertex_count(newprovgeom))
+
                 # For each change
+                skipped = 0
                 for change in changes:
-                    print change.type, change.fromprov, change.toprov
+                    logger.debug("%s %s %s", change.type, change.fromprov, change.toprov)
+                    # breakaways and splits have no cutpoly
+                    cutpoly = getattr(change, "cutpoly", None)
+                    # prepared once, for the cut and the error checks
+                    prepared = shapely.prepared.prep(cutpoly) if cutpoly else None
 
                     # Handle each type of change separately
                     if change.type in "MergeNew MergeExisting":
                         # Get the geom that was transferred as the intersection with the change cutpoly
-                        change.geom = newprovgeom.intersection(change.cutpoly)
-                        newprovgeom = newprovgeom.difference(change.cutpoly) # trim the geom for each time so no overlap
+                        # and trim the geom for each time so no overlap
+                        with self.profiler.span("cut"):
+                            change.geom,newprovgeom = self.cut(newprovgeom, cutpoly, prepared)
                         allsubparts.append(change)
 
                     elif change.type in "TransferNew TransferExisting":
                         # Get the geom that was transferred as the intersection with the change cutpoly
-                        change.geom = newprovgeom.intersection(change.cutpoly)
-                        newprovgeom = newprovgeom.difference(change.cutpoly) # trim the geom for each time so no overlap
+                        # and trim the geom for each time so no overlap
+                        with self.profiler.span("cut"):
+                            change.geom,newprovgeom = self.cut(newprovgeom, cutpoly, prepared)
                         allsubparts.append(change)
 
                     elif change.type in "Breakaway SplitPart":
@@ -358,33 +768,22 @@ class ResultsTable:
 
                     # Error checking
                     if change.type not in "NewInfo Begin":
-                        
                         if change.geom.is_empty:
-                            import pythongis as pg
-                            mapp = pg.renderer.Map(500, 500, title="Error: No intersection found (%s)" % newprov.end)
-                            
-                            dat = pg.VectorData(type="Polygon")
-                            dat.fields = ["Text"]
-                            dat.add_feature(["orig geom"], shapely.geometry.shape(newprov.geometry).__geo_interface__)
-                            mapp.add_layer(dat, fillcolor=pg.renderer.rgb("red"), legendoptions=dict(title="to "+newprov.ids["Name"]))
-
-                            dat = pg.VectorData(type="Polygon")
-                            dat.fields = ["Text"]
-                            dat.add_feature(["cutpoly"], change.cutpoly.__geo_interface__)
-                            mapp.add_layer(dat, fillcolor=pg.renderer.rgb("blue"), legendoptions=dict(title="from "+change.fromprov.ids["Name"]))
-                            
-                            mapp.add_legend(xy=("99%w","99%h"), anchor="se")
-
-                            mapp.zoom_bbox(*mapp.layers.bbox)
-                            #mapp.zoom_auto()
-                            mapp.zoom_out(2)
-                            #print mapp.zooms
-                            mapp.view()
-                        
-                            raise Exception("No intersection found, cutpoly must have at least some overlap with the province")
+                            if cutpoly:
+                                overlaps = [p for p in self.query(cutpoly, newprov.country) if prepared.intersects(p.shape)]
+                                message = "No intersection found, cutpoly must have at least some overlap with the province (cutpoly instead overlaps %s)" % overlaps
+                            else:
+                                message = "No intersection found, the cutpolys of earlier changes already took all of the province %s" % newprov
+                            self.diagnostics.failure("nointersection", message,
+                                                     [("to "+newprov.ids["Name"], newprov.shape), ("from "+change.fromprov.ids["Name"], cutpoly)],
+                                                     date=event.date, country=newprov.country, change=repr(change), end=newprov.end,
+                                                     fromprov=change.fromprov.ids, toprov=change.toprov.ids)
+                            # skip the change
+                            allsubparts.remove(change)
+                            skipped += 1
                         
                         elif not change.geom.is_valid or "Polygon" not in change.geom.geom_type:
-                            print change.geom.geom_type
+                            logger.debug("%s", change.geom.geom_type)
                             invalid = True
                             if change.geom.geom_type == "GeometryCollection":
                                 # some linestrings likely crept in, we only care about the polys
@@ -395,28 +794,22 @@ class ResultsTable:
                                         break
 
                             if invalid:
-                                import pythongis as pg
-                                mapp = pg.renderer.Map(500, 500, title="Error: Invalid intersection (%s)" % newprov.end)
-                                
-                                dat = pg.VectorData(type="Polygon")
-                                dat.fields = ["Text"]
-                                dat.add_feature(["orig geom"], shapely.geometry.shape(newprov.geometry).__geo_interface__)
-                                mapp.add_layer(dat, fillcolor=pg.renderer.rgb("red"), legendoptions=dict(title="to "+newprov.ids["Name"]))
-
-                                dat = pg.VectorData(type="Polygon")
-                                dat.fields = ["Text"]
-                                dat.add_feature(["cutpoly"], change.cutpoly.__geo_interface__)
-                                mapp.add_layer(dat, fillcolor=pg.renderer.rgb("blue"), legendoptions=dict(title="from "+change.fromprov.ids["Name"]))
-                                
-                                mapp.add_legend(xy=("99%w","99%h"), anchor="se")
-
-                                mapp.zoom_bbox(*mapp.layers.bbox)
-                                #mapp.zoom_auto()
-                                mapp.zoom_out(2)
-                                #print mapp.zooms
-                                mapp.view()
+                                self.diagnostics.failure("invalidintersection",
+                                                         "Invalid intersection between %s and %s" % (newprov,change),
+                                                         [("to "+newprov.ids["Name"], newprov.shape), ("from "+change.fromprov.ids["Name"], cutpoly)],
+                                                         date=event.date, country=newprov.country, change=repr(change), end=newprov.end,
+                                                         fromprov=change.fromprov.ids, toprov=change.toprov.ids)
+                                # skip the change
+                                allsubparts.remove(change)
+                                skipped += 1
+
+                if skipped == len(changes):
+                    # nothing happened to the toprov after all, so it stays as it is
+                    continue
 
-                                raise Exception("Invalid intersection between %s and %s" % (newprov,change) )
+                # Also change the startdate of the newer prov
+                newprov.start = event.date
+                logger.debug("changed date %s %s %s", newprov, newprov.start, newprov.end)
 
                 # If newinfo is the only change
                 if len(changes) == 1 and changes[0].type == "NewInfo":
@@ -440,7 +833,8 @@ class ResultsTable:
                     # Otherwise, this was its first creation
                     trimmedgeom = newprovgeom
                     if not trimmedgeom.is_empty:
-                        print "trimmedgeom", trimmedgeom.area
+                        if debug:
+                            logger.debug("trimmedgeom %s", trimmedgeom.area)
                         newinfo = next((change for change in changes if change.type == "NewInfo"), None)
                         if newinfo:
                             prereceiving = Remainder(newinfo.fromprov, trimmedgeom)
@@ -452,22 +846,10 @@ class ResultsTable:
 
 
             # 2) Group and union all geom parts by fromprov
-            print "by fromprov"
-            def groupsimilar(allsubparts):
-                key = lambda ch: ch.fromprov.country
-                for fromprovcountry,subparts in itertools.groupby(sorted(allsubparts, key=key), key=key):
-                    subparts = list(subparts)
-                    grp = []
-                    while subparts:
-                        frst = subparts.pop(0)
-                        grp.append(frst)
-                        for nxt in reversed(subparts):
-                            if ids_equal(frst.fromprov,nxt.fromprov):
-                                grp.append(nxt)
-                                subparts.remove(nxt)
-                        yield fromprovcountry, grp
-                        grp = []
-            for fromprovcountry,subparts in groupsimilar(allsubparts):
+            logger.debug("by fromprov")
+            for fromprovcountry,subparts in group_similar(allsubparts):
+                if countryspan: countryspan.stop()
+                countryspan = self.profiler.span("country", fromprovcountry)
                 subparts = list(subparts)
                 fromprov = subparts[0].fromprov
                 if fromprov.ids["Name"] == "*":
@@ -477,24 +859,27 @@ class ResultsTable:
                 if "MergeNew" not in (p.type for p in subparts) \
                    and "MergeExisting" not in (p.type for p in subparts) \
                    and "NewInfo" not in (p.type for p in subparts):
-                    oldprov = self.find_prov(fromprov)
+                    with self.profiler.span("find_prov"):
+                        oldprov = self.find_prov(fromprov)
                     if oldprov and oldprov.start is None:
-                        print "REMAAAAAAAAINS:",fromprov,oldprov
+                        logger.debug("REMAAAAAAAAINS: %s %s", fromprov, oldprov)
                         oldprov.start = event.date
-                        oldprovgeom = shapely.geometry.shape(oldprov.geometry)
+                        oldprovgeom = oldprov.shape
                         pregiving = Remainder(fromprov, oldprovgeom)
                         subparts.append(pregiving)
                     elif oldprov and oldprov.start:
-                        print "NOT REMAINS:",oldprov
+                        logger.debug("NOT REMAINS: %s", oldprov)
                 
                 # Union all parts belonging to same fromprov, ie breakaways and parttransfers
                 if len(subparts) > 1:
-                    print fromprov, "union", [(p,p.geom.geom_type,"Empty" if p.geom.is_empty else "OK") for p in subparts]
-                    fullgeom = shapely.ops.cascaded_union([part.geom for part in subparts])
+                    if debug:
+                        logger.debug("%s union %s", fromprov, [(p,p.geom.geom_type,"Empty" if p.geom.is_empty else "OK") for p in subparts])
+                    with self.profiler.span("union"):
+                        fullgeom = union_parts([part.geom for part in subparts], self.union)
                    
                 else:
                     # Only one item, so prob means there was nothing left of the giving prov, ie fulltransfers or maybe also just newinfo
-                    print fromprov, "single", subparts
+                    logger.debug("%s single %s", fromprov, subparts)
                     fullgeom = subparts[0].geom
                     
 
@@ -507,34 +892,19 @@ class ResultsTable:
                 try: fullgeom = fullgeom.buffer(0) 
                 except: pass
 
-                # Beautification! WARNING: SLOW!
-                try:
-                    fixed = fullgeom.buffer(0.00001).buffer(-0.00001) # fill in hole slivers
-                    if fixed.is_valid:
-                        fullgeom = fixed
-                except:
-                    print 'NB! hole slivers failed'
-                    pass
-                try:
-                    fixed = fullgeom.buffer(-0.00001).buffer(0.00001) # strip away island slivers
-                    if fixed.is_empty:
-                        print 'skipping tiny island sliver!'
-                        continue
-                    if fixed.is_valid:
-                        fullgeom = fixed
-                except:
-                    print 'NB! island slivers failed'
-                    pass
-                try:
-                    fullgeom = fullgeom.simplify(0.0001, preserve_topology=True)  # reduce filesize
-                except:
-                    print 'NB! simplify failed'
-                    pass
+                # Beautification, see beautify.py
+                with self.profiler.span("beautify"):
+                    fullgeom = self.beautifier(fullgeom, fromprov)
+                if fullgeom is None:
+                    continue
                 
                 if fullgeom.is_empty:
-                    raise Exception("Something went wrong, output province %s has empty geometry" % fromprov)
+                    self.diagnostics.failure("emptyoutput", "Something went wrong, output province %s has empty geometry" % fromprov,
+                                             [(repr(part), part.geom) for part in subparts],
+                                             date=event.date, country=fromprov.country, fromprov=fromprov.ids)
+                    continue
                 elif not fullgeom.is_valid or "Polygon" not in fullgeom.geom_type:
-                    print "!!!!!!!!!!!!!!!!!!!! skipping invalid leftover geom"
+                    logger.warning("skipping invalid leftover geom of %s", fromprov)
                     #global fullgeom
                     #fullgeom = fullgeom # so can check it after error
                     #raise Exception("Something went wrong, output province %s has invalid geometry" % fromprov)
@@ -557,18 +927,24 @@ class ResultsTable:
 ##                    pg.vector.data.Feature(dat, [], fullgeom.__geo_interface__).view(500,500)
 ##                    ###
 
-                print "added", fromprov, fromprov.start, fromprov.end
+                logger.debug("added %s %s %s", fromprov, fromprov.start, fromprov.end)
                 
-                self.add_province(country=fromprov.country,
-                                  start=None,
-                                 end=event.date,
-                                 ids=fromprov.ids,
-                                 other=fromprov.other,
-                                 geometry=fullgeom.__geo_interface__)
+                with self.profiler.span("add_province"):
+                    self.add_province(country=fromprov.country,
+                                      start=None,
+                                     end=event.date,
+                                     ids=fromprov.ids,
+                                     other=fromprov.other,
+                                     geometry=fullgeom)
+                self.beautifier.added(self.provs[-1])
+                if self.profiler.enabled:
+                    self.profiler.count("output vertices", vertex_count(fullgeom))
 
             # 4) Maybe change all remaining provs via *
             key = lambda ch: ch.toprov.country
             for toprovcountry,countrychanges in itertools.groupby(sorted(event.changes, key=key), key=key):
+                if countryspan: countryspan.stop()
+                countryspan = self.profiler.span("country", toprovcountry)
                 countrychanges = list(countrychanges)
                 rest = next((ch for ch in countrychanges if ch.toprov.ids["Name"] == "*"), None)
                 if rest:
@@ -579,6 +955,7 @@ class ResultsTable:
                         # TODO: ONLY WORKS FOR NEWINFO...?
                         if prov.country == toprovcountry and prov.start == None:
                             addprovs.append(prov)
+                    copies = []
                     for prov in addprovs:
                         # finalize the newer
                         prov.start = event.date
@@ -590,7 +967,27 @@ class ResultsTable:
                                          end=event.date,
                                          ids=prov.ids,
                                          other=prov.other,
-                                         geometry=prov.geometry)
+                                         geometry=prov.shape)
+                        copies.append((prov, self.provs[-1]))
+                    self.beautifier.copied(copies)
+
+            if countryspan: countryspan.stop()
+            eventspan.stop()
+
+            done += 1
+            if self.checkpoints and self.checkpoints.due(done, events):
+                with self.profiler.span("checkpoint"):
+                    # pending deferred beautification refers to the same provs, so they are saved together,
+                    # and so are the failures so far, to have them all in the manifest of a resumed run
+                    self.checkpoints.save(checkpointkey, (done, self.provs, getattr(self.beautifier, "pending", None),
+                                                          self.diagnostics.failures))
+
+        # deferred beautification
+        with self.profiler.span("beautify"):
+            self.beautifier.finalize(self)
+
+        if self.checkpoints:
+            self.checkpoints.remove(checkpointkey)
 
         # finally set mindate for all (TODO: replace this with special firstdate events)
 ##        for prov in self.provs:
@@ -0,0 +1,144 @@
+# -*- coding: utf8 -*-
+
+"""
+Lightweight instrumentation of a build: named timing spans around each stage,
+optionally broken down by a key such as the event date or country,
+and counters such as the number of province comparisons.
+
+A Profiler collects these, and can be saved as a JSON report or printed as a short summary.
+When profiling is off a NullProfiler is used instead, whose methods do nothing,
+so the instrumented code costs little more than the method calls.
+"""
+
+import time
+import json
+
+
+class Span(object):
+    "Timing of one span, from when it is created until stop() or the end of a with block"
+    __slots__ = ("profiler", "name", "key", "start")
+
+    def __init__(self, profiler, name, key):
+        self.profiler = profiler
+        self.name = name
+        self.key = key
+        self.start = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stop(self):
+        self.profiler.record(self.name, time.time() - self.start, self.key)
+
+class Profiler:
+    enabled = True
+
+    def __init__(self):
+        self.created = time.time()
+        # name -> [count, seconds, max seconds]
+        self.spans = dict()
+        # name -> key -> seconds
+        self.keys = dict()
+        self.counters = dict()
+
+    def span(self, name, key=None):
+        "Starts timing a span, see Span"
+        return Span(self, name, key)
+
+    def record(self, name, seconds, key=None):
+        stats = self.spans.get(name)
+        if stats is None:
+            stats = self.spans[name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+        if key is not None:
+            if not isinstance(key, basestring):
+                key = str(key)
+            keyed = self.keys.setdefault(name, dict())
+            keyed[key] = keyed.get(key, 0.0) + seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, other):
+        "Add the spans and counters of another profiler, eg from a worker process"
+        for name,(count,seconds,maxseconds) in other.spans.items():
+            stats = self.spans.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += count
+            stats[1] += seconds
+            stats[2] = max(stats[2], maxseconds)
+        for name,keyed in other.keys.items():
+            ownkeyed = self.keys.setdefault(name, dict())
+            for key,seconds in keyed.items():
+                ownkeyed[key] = ownkeyed.get(key, 0.0) + seconds
+        for name,n in other.counters.items():
+            self.count(name, n)
+
+    def report(self):
+        "Machine readable report as a dict"
+        return {"wallclock": time.time() - self.created,
+                "spans": dict((name, {"count": count, "seconds": seconds, "max": maxseconds})
+                              for name,(count,seconds,maxseconds) in self.spans.items()),
+                "keys": self.keys,
+                "counters": self.counters}
+
+    def save(self, filename):
+        "Save the report as JSON"
+        with open(filename, "wb") as writer:
+            json.dump(self.report(), writer, indent=4, sort_keys=True)
+
+    def summary(self, slowest=5):
+        "Short human readable summary, with the slowest keys of each span"
+        lines = ["Profile (%.2f s wallclock):" % (time.time() - self.created)]
+        for name,(count,seconds,maxseconds) in sorted(self.spans.items(), key=lambda item: -item[1][1]):
+            lines.append("  %s: %.2f s in %s spans (max %.3f s)" % (name, seconds, count, maxseconds))
+            keyed = self.keys.get(name)
+            if keyed:
+                for key,keyseconds in sorted(keyed.items(), key=lambda item: -item[1])[:slowest]:
+                    lines.append("    %s: %.2f s" % (key, keyseconds))
+        for name,n in sorted(self.counters.items()):
+            lines.append("  %s: %s" % (name, n))
+        return "\n".join(lines)
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def stop(self):
+        pass
+
+_nullspan = _NullSpan()
+
+class NullProfiler:
+    "Same interface as Profiler, but does nothing"
+    enabled = False
+
+    def span(self, name, key=None):
+        return _nullspan
+
+    def record(self, name, seconds, key=None):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def merge(self, other):
+        pass
+
+    def report(self):
+        return {}
+
+    def save(self, filename):
+        pass
+
+    def summary(self, slowest=5):
+        return "Profiling was off"
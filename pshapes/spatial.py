@@ -0,0 +1,103 @@
+# -*- coding: utf8 -*-
+
+"""
+Spatial index over items with geometries, backed by shapely's STRtree.
+Works with both shapely 1.x (where queries return geometries) and 2.x (where they return indices).
+Also a grid index for looking up lots of points in the same geometries.
+"""
+
+import shapely, shapely.geometry, shapely.prepared
+from shapely.strtree import STRtree
+
+
+SHAPELY2 = int(shapely.__version__.split(".")[0]) >= 2
+
+class SpatialIndex:
+    def __init__(self, items, geoms):
+        "Items can be anything, geoms are their shapely geometries in the same order"
+        self.items = list(items)
+        self.geoms = list(geoms)
+        self.tree = STRtree(self.geoms) if self.geoms else None
+        if not SHAPELY2:
+            # 1.x queries return the inserted geometries, so map them back to their position
+            self._positions = dict((id(geom),i) for i,geom in enumerate(self.geoms))
+
+    def __len__(self):
+        return len(self.items)
+
+    def query_positions(self, geom, predicate=None):
+        """
+        Positions of all items whose bounding box intersects geom, in the order they were given.
+        If predicate is given, eg "intersects" or "within", only those where predicate(geom, itemgeom) is true. 
+        """
+        if self.tree is None:
+            return []
+        if SHAPELY2:
+            positions = self.tree.query(geom, predicate=predicate)
+            return sorted(int(i) for i in positions)
+        else:
+            positions = sorted(self._positions[id(hit)] for hit in self.tree.query(geom))
+            if predicate:
+                test = getattr(shapely.prepared.prep(geom), predicate)
+                positions = [i for i in positions if test(self.geoms[i])]
+            return positions
+
+    def query(self, geom, predicate=None):
+        "Same as query_positions, but returns the items"
+        return [self.items[i] for i in self.query_positions(geom, predicate)]
+
+class GridIndex:
+    """
+    Uniform grid over prepared geometries, for point lookups without making a shapely point.
+    Each cell is either decided, ie inside the first geometry that intersects it,
+    or lists the positions of the geometries that intersect it, in the order they were given.
+    """
+    # cells per geometry when no cellsize is given
+    density = 64
+
+    def __init__(self, geoms, prepared, cellsize=None):
+        "Geoms are shapely geometries, prepared are the same geometries prepared by shapely.prepared.prep"
+        self.cells = dict()
+        if not geoms:
+            self.bounds = None
+            return
+        allbounds = [geom.bounds for geom in geoms]
+        xmin,ymin = min(b[0] for b in allbounds),min(b[1] for b in allbounds)
+        xmax,ymax = max(b[2] for b in allbounds),max(b[3] for b in allbounds)
+        self.bounds = xmin,ymin,xmax,ymax
+        if cellsize is None:
+            cellsize = ((xmax - xmin) * (ymax - ymin) / float(self.density * len(geoms))) ** 0.5 or 1.0
+        self.cellsize = cellsize
+        # cells are tested slightly enlarged, so points rounded into a cell are still covered
+        pad = cellsize * 1e-6
+        candidates = dict()
+        for i,(x1,y1,x2,y2) in enumerate(allbounds):
+            for cx in range(int((x1 - xmin) / cellsize), int((x2 - xmin) / cellsize) + 1):
+                for cy in range(int((y1 - ymin) / cellsize), int((y2 - ymin) / cellsize) + 1):
+                    candidates.setdefault((cx,cy), []).append(i)
+        for cell,positions in candidates.items():
+            cx,cy = cell
+            cellbox = shapely.geometry.box(xmin + cx * cellsize - pad, ymin + cy * cellsize - pad,
+                                           xmin + (cx + 1) * cellsize + pad, ymin + (cy + 1) * cellsize + pad)
+            hits = []
+            for i in positions:
+                if not hits and prepared[i].contains(cellbox):
+                    # no earlier geometry in the way, so the whole cell is decided
+                    hits = i
+                    break
+                if prepared[i].intersects(cellbox):
+                    hits.append(i)
+            if hits != []:
+                self.cells[cell] = hits
+
+    def lookup(self, x, y):
+        """
+        Position of the geometry containing the point if its cell is decided,
+        otherwise a list of the positions that may contain it, empty if none.
+        """
+        if self.bounds is None:
+            return []
+        xmin,ymin,xmax,ymax = self.bounds
+        if not (xmin <= x <= xmax and ymin <= y <= ymax):
+            return []
+        return self.cells.get((int((x - xmin) / self.cellsize), int((y - ymin) / self.cellsize)), [])
@@ -0,0 +1,165 @@
+# -*- coding: utf8 -*-
+
+"""
+Timeline store of backtracked provinces, for as-of queries without scanning all of them:
+- all provinces of a country valid on a date
+- the province containing a point on a date
+
+A province is valid from its start date up to but not including its end date,
+where a start of None means it existed since before the earliest recorded change,
+and an end of None, or of the present (the maxdate of the ResultsTable), means it still exists.
+The dates where any province starts or ends divide the timeline into slices,
+within which the set of valid provinces does not change. Each country has its own slices,
+and the global slices each get a spatial index, both built the first time they are queried.
+"""
+
+import bisect
+import datetime
+import json
+import dateutil, dateutil.parser
+import shapely, shapely.geometry, shapely.prepared
+
+from .process import Province, MAXDATE
+from .spatial import SpatialIndex, GridIndex
+
+
+def parse_date(date):
+    "Date object from a date, datetime, or date string, with None or 'None' meaning open-ended"
+    if date is None or date == "None":
+        return None
+    if isinstance(date, datetime.datetime):
+        return date.date()
+    if isinstance(date, datetime.date):
+        return date
+    date = dateutil.parser.parse(date)
+    return datetime.date(year=date.year, month=date.month, day=date.day)
+
+def valid_on(prov, date, present=MAXDATE):
+    return (prov.start is None or prov.start <= date) and (prov.end is None or prov.end == present or date < prov.end)
+
+class _Slices:
+    "Interval index over some provs, with the valid ones in each slice computed on first use"
+    def __init__(self, provs, positions, present=MAXDATE):
+        self.provs = provs
+        self.positions = positions
+        self.present = present
+        dates = set()
+        for i in positions:
+            prov = provs[i]
+            if prov.start is not None: dates.add(prov.start)
+            if prov.end is not None and prov.end != present: dates.add(prov.end)
+        # slice k runs from breaks[k-1] up to breaks[k], the first and last being open-ended
+        self.breaks = sorted(dates)
+        self._members = dict()
+
+    def slice_of(self, date):
+        return bisect.bisect_right(self.breaks, date)
+
+    def members(self, k):
+        "Positions of the provs valid in slice k"
+        if k not in self._members:
+            if k > 0:
+                # any date in the slice will do, since nothing starts or ends within it
+                date = self.breaks[k-1]
+                self._members[k] = tuple(i for i in self.positions if valid_on(self.provs[i], date, self.present))
+            else:
+                # before any recorded change, only those with open start
+                self._members[k] = tuple(i for i in self.positions if self.provs[i].start is None)
+        return self._members[k]
+
+class Timeline:
+    def __init__(self, provs, present=MAXDATE):
+        """
+        Provs are Province objects with start and end dates, eg the provs of a backtracked ResultsTable.
+        Present is the end date given to provinces that still exist, and is treated as open-ended.
+        """
+        self.provs = list(provs)
+        self.present = present
+        bycountry = dict()
+        for i,prov in enumerate(self.provs):
+            bycountry.setdefault(prov.country, []).append(i)
+        self._countries = dict((country,_Slices(self.provs, positions, present))
+                               for country,positions in bycountry.items())
+        self._global = _Slices(self.provs, range(len(self.provs)), present)
+        # slice -> spatial index and prepared geoms of its provs
+        self._spatial = dict()
+        # slice -> grid index of its provs
+        self._grids = dict()
+
+    @classmethod
+    def from_results(cls, table):
+        "From a backtracked ResultsTable"
+        return cls(table.provs, table.maxdate)
+
+    @classmethod
+    def from_geojson(cls, filename, present=MAXDATE):
+        "From the GeoJSON file written by build()"
+        with open(filename, "rb") as reader:
+            data = json.load(reader)
+        provs = []
+        for feat in data["features"]:
+            props = feat["properties"]
+            alterns = props.get("alterns") or []
+            if not isinstance(alterns, list):
+                alterns = alterns.split("|")
+            provs.append(Province(country=props["country"],
+                                  start=parse_date(props.get("start")),
+                                  end=parse_date(props.get("end")),
+                                  ids={"Name": props.get("name"),
+                                       "Alterns": alterns,
+                                       "HASC": props.get("hasc"),
+                                       "ISO": props.get("iso"),
+                                       "FIPS": props.get("fips")},
+                                  other={"Type": props.get("type"),
+                                         "Capital": props.get("capital")},
+                                  geometry=feat["geometry"]))
+        return cls(provs, present)
+
+    def countries(self):
+        return sorted(self._countries.keys())
+
+    def changes(self, country=None):
+        "Sorted dates where the provinces of a country, or of any country, change"
+        slices = self._countries.get(country) if country else self._global
+        return list(slices.breaks) if slices else []
+
+    def snapshot(self, country, date):
+        "All provinces of a country valid on date, in the order they were given"
+        slices = self._countries.get(country)
+        if slices is None:
+            return []
+        date = parse_date(date)
+        return [self.provs[i] for i in slices.members(slices.slice_of(date))]
+
+    def locate(self, lon, lat, date, country=None):
+        "The province containing the point on date, or None. Optionally limited to a country."
+        index,prepared = self.slice_index(self.slice_of(date))
+        point = shapely.geometry.Point(lon, lat)
+        for i in index.query_positions(point):
+            prov = self.provs[index.items[i]]
+            if (country is None or prov.country == country) and prepared[i].intersects(point):
+                return prov
+
+    def slice_of(self, date):
+        "The global slice of a date, ie the number of change dates up to and including it"
+        return self._global.slice_of(parse_date(date))
+
+    def slice_index(self, k):
+        """
+        Spatial index of the provs valid in global slice k, whose items are positions in self.provs,
+        along with their prepared geometries in the same order as the index.
+        """
+        if k not in self._spatial:
+            shapes = [(i,self.provs[i].shape) for i in self._global.members(k)]
+            positions = [i for i,geom in shapes if geom is not None and not geom.is_empty]
+            geoms = [geom for i,geom in shapes if geom is not None and not geom.is_empty]
+            self._spatial[k] = (SpatialIndex(positions, geoms),
+                                [shapely.prepared.prep(geom) for geom in geoms])
+        return self._spatial[k]
+
+    def slice_grid(self, k):
+        "Grid index of the provs valid in global slice k, in the same order as slice_index(k)"
+        if k not in self._grids:
+            index,prepared = self.slice_index(k)
+            self._grids[k] = GridIndex(index.geoms, prepared)
+        return self._grids[k]
@@ -5,6 +5,9 @@
 
 from pshapes import *
 
+import logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
 ##import pythongis as pg
 ##curtable = pg.VectorData(r"C:\Users\kimok\OneDrive\Documents\GitHub\PythonGis\tests\data\ne_10m_admin_1_states_provinces.shp", encoding="utf8", encoding_errors="replace")
 ##fdsfsd
@@ -5,6 +5,9 @@
 
 from pshapes import *
 
+import logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
 
 
 # load current data
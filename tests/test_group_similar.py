@@ -0,0 +1,70 @@
+# -*- coding: utf8 -*-
+
+# Locks in the grouping of subparts by their fromprov done by group_similar,
+# which must stay the same as the nested groupsimilar it replaced.
+# Run with: python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pshapes.process import Province, Remainder, group_similar
+
+
+def part(country, name, alterns=(), hasc=None):
+    ids = {"Name": name, "Alterns": list(alterns), "HASC": hasc, "ISO": None, "FIPS": None}
+    return Remainder(Province(country, None, None, ids, {}, None), None)
+
+def groups(subparts):
+    "Groups as (country, names) pairs"
+    return [(country, [subpart.fromprov.ids["Name"] for subpart in grp])
+            for country,grp in group_similar(subparts)]
+
+class TestGroupSimilar(unittest.TestCase):
+
+    def test_later_matches_reversed(self):
+        subparts = [part("A", "One"), part("A", "Two"), part("A", "One (2)", ["One"]), part("A", "One", hasc="AA.ON")]
+        self.assertEqual(groups(subparts),
+                         [("A", ["One", "One", "One (2)"]),
+                          ("A", ["Two"])])
+
+    def test_not_transitive(self):
+        # first matches second, second matches third, but first doesnt match third
+        subparts = [part("A", "First", ["Second"]), part("A", "Second", ["Third"]), part("A", "Third")]
+        self.assertEqual(groups(subparts),
+                         [("A", ["First", "Second"]),
+                          ("A", ["Third"])])
+
+    def test_not_transitive_later(self):
+        # the third is grouped with the second when the second comes first
+        subparts = [part("A", "Second", ["Third"]), part("A", "First", ["Second"]), part("A", "Third")]
+        self.assertEqual(groups(subparts),
+                         [("A", ["Second", "Third", "First"])])
+
+    def test_hasc_match(self):
+        subparts = [part("A", "One", hasc="AA.ON"), part("A", "Uno", hasc="AA.ON"), part("A", "Un", hasc="AA.UN")]
+        self.assertEqual(groups(subparts),
+                         [("A", ["One", "Uno"]),
+                          ("A", ["Un"])])
+
+    def test_countries_separate(self):
+        # same names in different countries are never grouped, and countries come in sorted order
+        subparts = [part("B", "One"), part("A", "One"), part("B", "One"), part("A", "Two")]
+        self.assertEqual(groups(subparts),
+                         [("A", ["One"]),
+                          ("A", ["Two"]),
+                          ("B", ["One", "One"])])
+
+    def test_same_objects(self):
+        subparts = [part("A", "One"), part("A", "One")]
+        grouped = [grp for country,grp in group_similar(subparts)]
+        self.assertEqual(len(grouped), 1)
+        self.assertTrue(grouped[0][0] is subparts[0] and grouped[0][1] is subparts[1])
+
+    def test_empty(self):
+        self.assertEqual(groups([]), [])
+
+if __name__ == "__main__":
+    unittest.main()